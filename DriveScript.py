@@ -12,27 +12,38 @@ Upon first run it will create `token.json` for OAuth credentials.
 
 import io
 import os
+import shutil
 import sys
+from functools import lru_cache
 from typing import List, Dict
 
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
-from googleapiclient.http import MediaIoBaseDownload
+import requests
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
+from google.auth.transport.requests import AuthorizedSession, Request
 
 # Scope providing read-only access to the user's Drive.
 SCOPES = ["https://www.googleapis.com/auth/drive.readonly"]
 # ID of the shared folder "CO ICF HELP GLOBAL".
 ROOT_FOLDER_ID = "1KNvnzuBL_froKQs-JVd8TVoGDMtL4-wx"
+# Shared transport for token refreshes, so its HTTP session is reused.
+_AUTH_REQUEST = Request()
+# Working directory downloads are saved to, captured once at start-up.
+CWD = os.getcwd()
+# Drive v3 files endpoint used for direct media downloads.
+DRIVE_FILES_URL = "https://www.googleapis.com/drive/v3/files"
+# Read size while streaming a download to disk (1 MiB).
+DOWNLOAD_CHUNK = 1024 * 1024
 
 
+@lru_cache(maxsize=1)
 def authenticate() -> Credentials:
     """Authenticate the user and return valid credentials.
 
     If a saved token exists it will be used; otherwise an OAuth flow will be
-    initiated and `token.json` will be created.
+    initiated and `token.json` will be created. The result is cached for the
+    lifetime of the process, and `token.json` is only rewritten when the
+    token actually changed.
     """
 
     creds: Credentials | None = None
@@ -40,38 +51,50 @@ def authenticate() -> Credentials:
         creds = Credentials.from_authorized_user_file("token.json", SCOPES)
 
     if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
+        previous_token = creds.token if creds else None
+        if creds and creds.refresh_token:
+            creds.refresh(_AUTH_REQUEST)
         else:
             flow = InstalledAppFlow.from_client_secrets_file(
                 "client_secret.json", SCOPES
             )
             creds = flow.run_local_server(port=0)
-        with open("token.json", "w", encoding="utf-8") as token:
-            token.write(creds.to_json())
+        if creds.token != previous_token:
+            with open("token.json", "w", encoding="utf-8") as token:
+                token.write(creds.to_json())
     return creds
 
 
-def find_case_folder(service, case_number: str) -> str | None:
+def _drive_list(session: AuthorizedSession, **params) -> Dict:
+    """Call Drive ``files.list`` over REST on the shared session.
+
+    Listing and downloading then go over the same keep-alive connection to
+    www.googleapis.com instead of a separate discovery-client transport.
+    """
+    resp = session.get(DRIVE_FILES_URL, params=params)
+    resp.raise_for_status()
+    return resp.json()
+
+
+def find_case_folder(session: AuthorizedSession, case_number: str) -> str | None:
     """Return the folder ID matching the given case number, if it exists."""
     query = (
         f"'{ROOT_FOLDER_ID}' in parents and "
         "mimeType='application/vnd.google-apps.folder' and "
         f"name='{case_number}' and trashed=false"
     )
-    results = service.files().list(q=query, fields="files(id, name)").execute()
+    results = _drive_list(session, q=query, fields="files(id)")
     folders: List[Dict[str, str]] = results.get("files", [])
     return folders[0]["id"] if folders else None
 
 
-def find_latest_grant_file(service, folder_id: str) -> Dict[str, str] | None:
+def find_latest_grant_file(session: AuthorizedSession, folder_id: str) -> Dict[str, str] | None:
     """Return metadata of the newest 'Grant Agreement*.pdf' file in the folder."""
     query = (
         f"'{folder_id}' in parents and mimeType!='application/vnd.google-apps.folder' "
         "and name contains 'Grant Agreement' and name contains '.pdf' and trashed=false"
     )
-    results = service.files().list(
-        q=query, fields="files(id, name, createdTime)").execute()
+    results = _drive_list(session, q=query, fields="files(id, name, createdTime, size)")
     files: List[Dict[str, str]] = results.get("files", [])
     # Filter to match prefix/suffix precisely and select the most recent by createdTime.
     grant_files = [
@@ -82,18 +105,45 @@ def find_latest_grant_file(service, folder_id: str) -> Dict[str, str] | None:
     return max(grant_files, key=lambda f: f["createdTime"])
 
 
-def download_file(service, file_id: str, name: str) -> None:
-    """Download the specified file to the current working directory."""
-    request = service.files().get_media(fileId=file_id)
-    filepath = os.path.join(os.getcwd(), name)
-    with open(filepath, "wb") as fh:
-        downloader = MediaIoBaseDownload(fh, request)
-        done = False
-        while not done:
-            status, done = downloader.next_chunk()
-            if status:
-                progress = int(status.progress() * 100)
-                print(f"Download {progress}%.")
+def _preallocate(fh: io.FileIO, size: int | None) -> None:
+    """Reserve ``size`` bytes for ``fh`` so the extents are allocated contiguously."""
+    if not size:
+        return
+    if hasattr(os, "posix_fallocate"):
+        os.posix_fallocate(fh.fileno(), 0, size)
+    else:
+        fh.truncate(size)
+
+
+def download_file(
+    session: AuthorizedSession, file_id: str, name: str, size: int | None = None
+) -> None:
+    """Download the specified file to the current working directory.
+
+    The file body is fetched with a single streamed GET and copied straight
+    from the socket into an unbuffered file. When ``size`` is known the file
+    is preallocated up front and the download progress is printed.
+    """
+    filepath = os.path.join(CWD, name)
+    with session.get(
+        f"{DRIVE_FILES_URL}/{file_id}",
+        params={"alt": "media", "supportsAllDrives": "true"},
+        stream=True,
+    ) as resp:
+        resp.raise_for_status()
+        resp.raw.decode_content = True  # Drive may send the body gzip-encoded
+        with io.FileIO(filepath, "wb") as fh:
+            _preallocate(fh, size)
+            if size:
+                written = 0
+                while (chunk := resp.raw.read(DOWNLOAD_CHUNK)):
+                    fh.write(chunk)
+                    written += len(chunk)
+                    print(f"Download {min(written * 100 // size, 100)}%.")
+            else:
+                shutil.copyfileobj(resp.raw, fh, DOWNLOAD_CHUNK)
+            # Trim back if the body turned out shorter than the metadata size.
+            fh.truncate(fh.tell())
     print(f"Downloaded '{name}' to '{filepath}'.")
 
 
@@ -105,24 +155,29 @@ def main() -> None:
     case_number = sys.argv[1]
 
     try:
-        creds = authenticate()
-        service = build("drive", "v3", credentials=creds)
+        # One authorized session carries every Drive call of the run.
+        session = AuthorizedSession(authenticate())
 
-        folder_id = find_case_folder(service, case_number)
+        folder_id = find_case_folder(session, case_number)
         if not folder_id:
             print(f"Case folder '{case_number}' not found.")
             return
 
-        latest_file = find_latest_grant_file(service, folder_id)
+        latest_file = find_latest_grant_file(session, folder_id)
         if not latest_file:
             print("No matching 'Grant Agreement' PDF files found.")
             return
 
-        download_file(service, latest_file["id"], latest_file["name"])
+        download_file(
+            session,
+            latest_file["id"],
+            latest_file["name"],
+            int(latest_file.get("size", 0)),
+        )
 
     except FileNotFoundError as err:
         print(f"Credential file missing: {err}")
-    except HttpError as error:
+    except requests.HTTPError as error:
         print(f"An error occurred: {error}")
 
 
@@ -6,7 +6,7 @@ DriveScript v1.1 (Verbose + Shared Drive aware)
 
 🔑  Требования:
     • client_secret.json   – рядом со скриптом
-    • pip install google-api-python-client google-auth google-auth-oauthlib
+    • pip install google-auth google-auth-oauthlib requests
 
 🔧  Запуск:
     python DriveScript.py 13297            # «тихий» режим
@@ -17,21 +17,24 @@ from __future__ import annotations
 import argparse
 import io
 import os
+import shutil
 import sys
-from datetime import datetime, timezone
+from functools import lru_cache
 from typing import Dict, List, Optional
 
-from google.auth.transport.requests import Request
+import requests
+from google.auth.transport.requests import AuthorizedSession, Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
-from googleapiclient.errors import HttpError
 
 # ────────────────────────── КОНСТАНТЫ ──────────────────────────
 ROOT_FOLDER_ID = "1KNvnzuBL_froKQs-JVd8TVoGDMtL4-wx"
 SCOPES = ["https://www.googleapis.com/auth/drive.readonly"]
 PAGE_SIZE = 1000      # сколько элементов за один запрос list()
+DOWNLOAD_CHUNK = 1024 * 1024  # размер одного куска при скачивании (1 MiB)
+DRIVE_FILES_URL = "https://www.googleapis.com/drive/v3/files"
+CWD = os.getcwd()     # куда сохраняем файлы (фиксируем один раз при старте)
+_AUTH_REQUEST = Request()  # один транспорт на все refresh → сессия переиспользуется
 # ────────────────────────────────────────────────────────────────
 
 
@@ -55,16 +58,22 @@ def log(msg: str, *, verbose: bool):
 
 
 # ─────────────────────────── OAuth 2.0 ─────────────────────────
+@lru_cache(maxsize=1)
 def get_credentials(verbose: bool) -> Credentials:
+    """Credentials на весь процесс; token.json пишется, только если токен изменился."""
     creds: Optional[Credentials] = None
     if os.path.exists("token.json"):
         creds = Credentials.from_authorized_user_file("token.json", SCOPES)
         log("🔑 token.json найден, пробую использовать его…", verbose=verbose)
 
     # обновляем при необходимости
-    if creds and creds.expired and creds.refresh_token:
+    if creds and not creds.valid and creds.refresh_token:
         log("🔄 Токен просрочен, пробую refresh…", verbose=verbose)
-        creds.refresh(Request())
+        previous_token = creds.token
+        creds.refresh(_AUTH_REQUEST)
+        if creds.token != previous_token:
+            with open("token.json", "w", encoding="utf-8") as f:
+                f.write(creds.to_json())
 
     # если токена нет или обновить не вышло → полный OAuth-flow
     if not creds or not creds.valid:
@@ -81,40 +90,55 @@ def get_credentials(verbose: bool) -> Credentials:
 
 
 # ─────────────────────── Работа с Drive API ─────────────────────
-def build_service(creds: Credentials, verbose: bool):
-    log("⚙️  Строю service object Drive v3…", verbose=verbose)
-    return build("drive", "v3", credentials=creds)
+@lru_cache(maxsize=1)
+def get_session(verbose: bool) -> AuthorizedSession:
+    """
+    Одна AuthorizedSession на процесс: и поиск, и скачивание идут по одному
+    keep-alive соединению к www.googleapis.com.
+    """
+    return AuthorizedSession(get_credentials(verbose))
+
+
+def _drive_list(session: AuthorizedSession, **params) -> Dict:
+    """files.list напрямую через REST, по всем дискам (включая Shared Drives)."""
+    params.update(
+        supportsAllDrives="true",
+        includeItemsFromAllDrives="true",
+        corpora="allDrives",
+    )
+    resp = session.get(DRIVE_FILES_URL, params=params)
+    resp.raise_for_status()
+    return resp.json()
 
 
-def list_subfolders(service, parent_id: str, verbose: bool) -> List[Dict]:
-    """Возвращает список всех подпапок в parent_id (1-й уровень)."""
+def list_subfolders(
+    session: AuthorizedSession, parent_id: str, verbose: bool, limit: Optional[int] = None
+) -> List[Dict]:
+    """
+    Возвращает список подпапок в parent_id (1-й уровень).
+    С limit — только первую страницу из limit элементов (один запрос).
+    """
     log(f"📑 Читаю содержимое папки {parent_id}…", verbose=verbose)
     items: List[Dict] = []
     page_token = None
     while True:
-        resp = (
-            service.files()
-            .list(
-                q=f"'{parent_id}' in parents "
-                  "and mimeType='application/vnd.google-apps.folder' "
-                  "and trashed=false",
-                fields="nextPageToken, files(id, name)",
-                includeItemsFromAllDrives=True,
-                supportsAllDrives=True,
-                corpora="allDrives",
-                pageSize=PAGE_SIZE,
-                pageToken=page_token,
-            )
-            .execute()
+        resp = _drive_list(
+            session,
+            q=f"'{parent_id}' in parents "
+              "and mimeType='application/vnd.google-apps.folder' "
+              "and trashed=false",
+            fields="nextPageToken, files(id, name)",
+            pageSize=limit or PAGE_SIZE,
+            pageToken=page_token,
         )
         items.extend(resp.get("files", []))
         page_token = resp.get("nextPageToken")
-        if not page_token:
+        if not page_token or limit:
             break
     return items
 
 
-def find_case_folder(service, case_id: str, verbose: bool) -> Optional[str]:
+def find_case_folder(session: AuthorizedSession, case_id: str, verbose: bool) -> Optional[str]:
     """Ищет подпапку case_id внутри ROOT_FOLDER_ID."""
     # 1) Прямая попытка (быстро)
     log(f"🔎 Ищу подпапку «{case_id}» напрямую…", verbose=verbose)
@@ -123,61 +147,49 @@ def find_case_folder(service, case_id: str, verbose: bool) -> Optional[str]:
         "mimeType='application/vnd.google-apps.folder' and "
         f"name='{case_id}' and trashed=false"
     )
-    resp = (
-        service.files()
-        .list(
-            q=query,
-            fields="files(id, name)",
-            includeItemsFromAllDrives=True,
-            supportsAllDrives=True,
-            corpora="allDrives",
-            pageSize=1,
-        )
-        .execute()
-    )
+    resp = _drive_list(session, q=query, fields="files(id)", pageSize=1)
     if resp.get("files"):
         return resp["files"][0]["id"]
 
-    # 2) Если не нашли — покажем,
-    #    что вообще лежит в корне (поможет глазами убедиться)
-    log("⚠️  Точная подпапка не найдена. "
-        "Список подпапок в корневой:", verbose=verbose)
-    children = list_subfolders(service, ROOT_FOLDER_ID, verbose)
-    for f in children[:20]:
-        log(f"   • {f['name']}  (ID: {f['id']})", verbose=verbose)
-    if len(children) > 20:
-        log(f"   …ещё {len(children) - 20} папок скрыто…", verbose=verbose)
+    # 2) Если не нашли — в verbose-режиме покажем,
+    #    что вообще лежит в корне (поможет глазами убедиться).
+    #    Хватает одной страницы: весь корень ради 20 строк не листаем.
+    if verbose:
+        log("⚠️  Точная подпапка не найдена. "
+            "Список подпапок в корневой:", verbose=verbose)
+        children = list_subfolders(session, ROOT_FOLDER_ID, verbose, limit=25)
+        for f in children[:20]:
+            log(f"   • {f['name']}  (ID: {f['id']})", verbose=verbose)
+        if len(children) > 20:
+            log("   …остальные папки скрыты…", verbose=verbose)
     return None
 
 
 # ─────────────────── поиск PDF Grant Agreement ──────────────
-def find_latest_grant(service, parent_id: str, verbose: bool) -> Optional[Dict]:
+def find_latest_grant(
+    session: AuthorizedSession, parent_id: str, verbose: bool
+) -> Optional[Dict]:
     """
-    Ищет ВСЕ PDF напрямую внутри parent_id, выбирает тот,
-    у которого name.lower().startswith("grant agreement").
-    Берёт самый свежий modifiedTime.
+    Ищет PDF напрямую внутри parent_id, чьё имя начинается с
+    «Grant Agreement». Drive отсекает PDF без этих слов и сортирует по
+    modifiedTime; `contains` совпадает и с середины имени («Copy of Grant
+    Agreement…»), поэтому префикс проверяем сами — берём самый свежий.
     """
     log("🔎 Ищу файлы «Grant Agreement*.pdf» в самой папке-кейсе…", verbose=verbose)
 
     query = (
         f"'{parent_id}' in parents and "
-        "mimeType='application/pdf' and trashed=false"
+        "mimeType='application/pdf' and "
+        "name contains 'Grant Agreement' and trashed=false"
     )
 
-    resp = (
-        service.files()
-        .list(
-            q=query,
-            fields="files(id, name, modifiedTime)",
-            includeItemsFromAllDrives=True,
-            supportsAllDrives=True,
-            corpora="allDrives",
-            pageSize=PAGE_SIZE,
-        )
-        .execute()
+    resp = _drive_list(
+        session,
+        q=query,
+        orderBy="modifiedTime desc",
+        fields="files(id, name, modifiedTime, size)",
+        pageSize=PAGE_SIZE,
     )
-
-    # фильтруем в питоне: имя ДОЛЖНО начинаться с «Grant Agreement» (регистр игнорируем)
     candidates = [
         f for f in resp.get("files", [])
         if f["name"].lower().startswith("grant agreement")
@@ -186,37 +198,74 @@ def find_latest_grant(service, parent_id: str, verbose: bool) -> Optional[Dict]:
     if not candidates:
         log("⚠️  Подходящих PDF не найдено. Ниже список всех PDF в папке:", verbose=verbose)
         if verbose:
-            for f in resp.get("files", [])[:30]:
+            # лишний запрос делаем только ради диагностики
+            every_pdf = _drive_list(
+                session,
+                q=f"'{parent_id}' in parents and "
+                  "mimeType='application/pdf' and trashed=false",
+                fields="files(name)",
+                pageSize=30,
+            )
+            for f in every_pdf.get("files", []):
                 print("   •", f["name"])
         return None
 
-    latest = max(candidates, key=lambda f: f["modifiedTime"])
+    latest = candidates[0]
     log(f"📄 Найден: {latest['name']} (modified {latest['modifiedTime']})", verbose=verbose)
     return latest
 
 
-def download(service, file_id: str, gdrive_name: str, verbose: bool):
+def _preallocate(fh: io.FileIO, size: Optional[int]):
+    """Заранее резервирует size байт под файл (если размер известен)."""
+    if not size:
+        return
+    if hasattr(os, "posix_fallocate"):
+        os.posix_fallocate(fh.fileno(), 0, size)
+    else:
+        fh.truncate(size)
+
+
+def download(
+    session: AuthorizedSession,
+    file_id: str,
+    gdrive_name: str,
+    verbose: bool,
+    size: Optional[int] = None,
+):
     """
     Скачивает файл file_id из Google Drive и сохраняет его в текущей
     директории под тем же именем, гарантируя расширение «.pdf».
+    Файл приходит одним потоковым GET и копируется из сокета прямо
+    в небуферизованный файл; при известном size место резервируется заранее,
+    а в verbose-режиме печатается процент скачанного.
     """
     # ── 1. Формируем локальное имя ──────────────────────────────
     local_name = gdrive_name
     if not local_name.lower().endswith(".pdf"):
         local_name += ".pdf"          # добавляем, если Drive-имя было без расширения
 
-    local_path = os.path.join(os.getcwd(), local_name)
+    local_path = os.path.join(CWD, local_name)
     log(f"⬇️  Скачиваю «{local_name}»…", verbose=verbose)
 
-    # ── 2. Качаем через MediaIoBaseDownload ─────────────────────
-    request = service.files().get_media(fileId=file_id)
-    with io.FileIO(local_path, "wb") as fh:
-        downloader = MediaIoBaseDownload(fh, request)
-        done = False
-        while not done:
-            status, done = downloader.next_chunk()
-            if status and verbose:
-                print(f"   {int(status.progress() * 100)} %")
+    # ── 2. Качаем одним потоковым GET ───────────────────────────
+    with session.get(
+        f"{DRIVE_FILES_URL}/{file_id}",
+        params={"alt": "media", "supportsAllDrives": "true"},
+        stream=True,
+    ) as resp:
+        resp.raise_for_status()
+        resp.raw.decode_content = True  # Drive может отдать тело в gzip
+        with io.FileIO(local_path, "wb") as fh:
+            _preallocate(fh, size)
+            if verbose and size:
+                written = 0
+                while (chunk := resp.raw.read(DOWNLOAD_CHUNK)):
+                    fh.write(chunk)
+                    written += len(chunk)
+                    print(f"   {min(written * 100 // size, 100)} %")
+            else:
+                shutil.copyfileobj(resp.raw, fh, DOWNLOAD_CHUNK)
+            fh.truncate(fh.tell())  # на случай, если тело короче size
 
     print(f"✅ Файл сохранён: {local_name}")
 
@@ -229,10 +278,9 @@ def main():
 
     print(f"🚀 Запуск DriveScript для кейса {args.case_id}")
     try:
-        creds = get_credentials(verbose)
-        service = build_service(creds, verbose)
+        session = get_session(verbose)
 
-        case_folder_id = find_case_folder(service, args.case_id, verbose)
+        case_folder_id = find_case_folder(session, args.case_id, verbose)
         if not case_folder_id:
             sys.exit("❌ Папка кейса не найдена. "
                      "Проверьте, правильно ли указан номер кейса "
@@ -240,18 +288,19 @@ def main():
 
         log(f"📂 case_folder_id = {case_folder_id}", verbose=verbose)
 
-        file_meta = find_latest_grant(service, case_folder_id, verbose)
+        file_meta = find_latest_grant(session, case_folder_id, verbose)
         if not file_meta:
             sys.exit("❌ В папке нет файлов «Grant Agreement*.pdf».")
 
         download(
-            service,
+            session,
             file_meta["id"],
             file_meta["name"],
             verbose=verbose,
+            size=int(file_meta.get("size", 0)),
         )
 
-    except HttpError as e:
+    except requests.HTTPError as e:
         sys.exit(f"Google API Error: {e}")
     except KeyboardInterrupt:
         sys.exit("\n⏹️  Прервано пользователем.")
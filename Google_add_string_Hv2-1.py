@@ -5,7 +5,8 @@ mega_script.py
 End-to-end помощник для кейса Help Global.
 
 Алгоритм
-1.  Принимает invoice_number (целое).
+1.  Принимает invoice_number (целое) или --batch-file со списком номеров
+    (тогда строки в таблицу уходят одним запросом в конце).
 2.  Формирует строку-папку «000XXXXX».
 3.  На Google Drive (CO ICF HELP GLOBAL) ищет подпапку-кейс.
 4.  Скачивает из неё:
@@ -28,19 +29,23 @@ End-to-end помощник для кейса Help Global.
 
 from __future__ import annotations
 import argparse
-import re
+import io
+import os
+import shutil
 import sys
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
-from typing import Dict, Optional
+from urllib.parse import quote
+from typing import Dict, List, Optional
 from importlib import util as _import_util
 
-from google.auth.transport.requests import Request
+import requests
+from requests.adapters import HTTPAdapter
+from google.auth.transport.requests import AuthorizedSession, Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
-from googleapiclient.errors import HttpError
 
 # ────────── GOOGLE CONSTANTS ──────────
 ROOT_FOLDER_ID = "1KNvnzuBL_froKQs-JVd8TVoGDMtL4-wx"
@@ -51,6 +56,11 @@ SCOPES = [
 SHEET_ID = "1Pr0rb89ZIsy2qiBkZAySPuEf9B_zdn58CDurhtnQm0U"
 SHEET_RANGE = "Help Global!A:L"
 PAGE_SIZE = 1000
+DOWNLOAD_CHUNK = 1024 * 1024  # 1 MiB на одну запись при потоковом скачивании
+DRIVE_FILES_URL = "https://www.googleapis.com/drive/v3/files"
+SHEETS_VALUES_URL = f"https://sheets.googleapis.com/v4/spreadsheets/{SHEET_ID}/values"
+CWD = Path.cwd()  # рабочая папка: сюда качаем PDF и здесь же папки кейсов
+_AUTH_REQUEST = Request()  # один транспорт на все refresh → сессия переиспользуется
 
 # ────────── ПУТИ К ВНУТРЕННИМ СКРИПТАМ ──────────
 FUNCTIONS_DIR = Path(
@@ -68,11 +78,12 @@ spec.loader.exec_module(parser_Invoice)               # type: ignore
 # ────────── SIMPLE FOLDER-CREATOR (адаптировано) ──────────
 CONSTANT_TEXT = "XXX"
 FORBIDDEN = r'<>:"/\\|?*'
+_FORBIDDEN_DROP = str.maketrans("", "", FORBIDDEN)  # для имён папок: удалить
+_FORBIDDEN_SUB = str.maketrans(dict.fromkeys(FORBIDDEN, "_"))  # для файлов: заменить на _
 
 def sanitize(name: str) -> str:
     """Удаляет запрещённые символы из имени папки."""
-    name = re.sub(f"[{re.escape(FORBIDDEN)}]", "", name)
-    return name.strip(" .")
+    return name.translate(_FORBIDDEN_DROP).strip(" .")
 
 
 def create_case_dir(date_iso: str, amount: float, invoice_number: int) -> Path:
@@ -81,23 +92,28 @@ def create_case_dir(date_iso: str, amount: float, invoice_number: int) -> Path:
     yy_mm = dt.strftime("%y-%m")
     amount_int = int(round(amount))
     dir_name = f"Нова {yy_mm} {CONSTANT_TEXT} {amount_int} №{invoice_number} Хелп"
-    dir_path = Path.cwd() / sanitize(dir_name)
+    dir_path = CWD / sanitize(dir_name)
     dir_path.mkdir(exist_ok=True)
     return dir_path
 
 
 # ────────── OAUTH ──────────
+@lru_cache(maxsize=1)
 def get_credentials() -> Credentials:
+    """Credentials на весь процесс; token.json пишется, только если токен изменился."""
     token_path = Path("token.json")
     creds: Optional[Credentials] = None
 
     if token_path.exists():
         creds = Credentials.from_authorized_user_file(token_path, SCOPES)
-        if creds and creds.expired and creds.refresh_token:
+        if creds and not creds.valid and creds.refresh_token:
+            previous_token = creds.token
             try:
-                creds.refresh(Request())
+                creds.refresh(_AUTH_REQUEST)
             except Exception:
                 creds = None
+            if creds and creds.token != previous_token:
+                token_path.write_text(creds.to_json(), encoding="utf-8")
 
     if not creds or not creds.valid:
         if not Path("client_secret.json").exists():
@@ -109,114 +125,158 @@ def get_credentials() -> Credentials:
     return creds
 
 
+def build_session(creds: Credentials) -> AuthorizedSession:
+    """
+    Одна AuthorizedSession с пулом keep-alive соединений на весь запуск:
+    через неё по REST идут и Drive (поиск и скачивание), и запись в Sheets.
+    """
+    session = AuthorizedSession(creds)
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+    return session
+
+
 # ────────── DRIVE HELPERS ──────────
-def find_case_folder(service, case_folder_name: str) -> Optional[str]:
+def _drive_list(session: AuthorizedSession, **params) -> Dict:
+    """
+    files.list напрямую через REST: идёт по тому же keep-alive соединению
+    к www.googleapis.com, что и скачивание PDF.
+    """
+    params.update(
+        supportsAllDrives="true",
+        includeItemsFromAllDrives="true",
+        corpora="allDrives",
+    )
+    resp = session.get(DRIVE_FILES_URL, params=params)
+    resp.raise_for_status()
+    return resp.json()
+
+
+def find_case_folder(session: AuthorizedSession, case_folder_name: str) -> Optional[str]:
     query = (
         f"'{ROOT_FOLDER_ID}' in parents and "
         "mimeType='application/vnd.google-apps.folder' and "
         f"name='{case_folder_name}' and trashed=false"
     )
-    resp = (
-        service.files()
-        .list(
-            q=query,
-            fields="files(id)",
-            supportsAllDrives=True,
-            includeItemsFromAllDrives=True,
-            corpora="allDrives",
-            pageSize=1,
-        )
-        .execute()
-    )
+    resp = _drive_list(session, q=query, fields="files(id)", pageSize=1)
     files = resp.get("files", [])
     return files[0]["id"] if files else None
 
 
-def find_first_pdf(service, parent_id: str, prefix: str) -> Optional[Dict]:
+def list_pdfs(session: AuthorizedSession, parent_id: str) -> List[Dict]:
+    """
+    PDF «Invoice*» и «Grant Agreement*» прямо внутри parent_id — одним
+    запросом list(); лишние PDF отсекает сам Drive.
+    """
     query = (
         f"'{parent_id}' in parents and "
-        "mimeType='application/pdf' and trashed=false"
-    )
-    resp = (
-        service.files()
-        .list(
-            q=query,
-            fields="files(id, name)",
-            supportsAllDrives=True,
-            includeItemsFromAllDrives=True,
-            corpora="allDrives",
-            pageSize=PAGE_SIZE,
-        )
-        .execute()
+        "mimeType='application/pdf' and "
+        "(name contains 'Invoice' or name contains 'Grant Agreement') and "
+        "trashed=false"
     )
-    for f in resp.get("files", []):
-        if f["name"].lower().startswith(prefix.lower()):
-            return f
-    return None
+    resp = _drive_list(session, q=query, fields="files(id, name, size)", pageSize=PAGE_SIZE)
+    return resp.get("files", [])
 
 
 def _clean_filename(name: str) -> str:
     """Убирает запрещённые символы Windows и лишние пробелы/точки."""
-    name = re.sub(f"[{re.escape(FORBIDDEN)}]", "_", name)
-    return name.strip(" .")
+    return name.translate(_FORBIDDEN_SUB).strip(" .")
+
+def _preallocate(fh: io.FileIO, size: Optional[int]):
+    """Заранее резервирует size байт под файл (если размер известен)."""
+    if not size:
+        return
+    if hasattr(os, "posix_fallocate"):
+        os.posix_fallocate(fh.fileno(), 0, size)
+    else:
+        fh.truncate(size)
+
 
-def download_pdf(service, file_meta: Dict, local_name: str) -> Path:
+def download_pdf(session: AuthorizedSession, file_meta: Dict, local_name: str) -> Path:
     # 1. дописываем .pdf, если нужно
     if not local_name.lower().endswith(".pdf"):
         local_name += ".pdf"
     # 2. чистим имя
     local_name = _clean_filename(local_name)
-    local_path = Path(local_name)
+    local_path = CWD / local_name
 
-    request = service.files().get_media(fileId=file_meta["id"])
-    with local_path.open("wb") as fh:
-        downloader = MediaIoBaseDownload(fh, request)
-        done = False
-        while not done:
-            _, done = downloader.next_chunk()
-    return local_path.resolve()
+    # 3. один потоковый GET вместо серии ranged-запросов
+    with session.get(
+        f"{DRIVE_FILES_URL}/{file_meta['id']}",
+        params={"alt": "media", "supportsAllDrives": "true"},
+        stream=True,
+    ) as resp:
+        resp.raise_for_status()
+        resp.raw.decode_content = True  # Drive может отдать тело в gzip
+        with io.FileIO(local_path, "wb") as fh:
+            # резервируем место заранее, пишем без буфера Python
+            _preallocate(fh, int(file_meta.get("size", 0)))
+            shutil.copyfileobj(resp.raw, fh, DOWNLOAD_CHUNK)
+            fh.truncate(fh.tell())  # на случай, если тело короче size
+    return local_path
+
+
+def move_file(src: Path, dst: Path) -> None:
+    """
+    Переносит файл: на том же диске — атомарный os.replace (без копирования),
+    между дисками — shutil.move (копия + удаление).
+    """
+    if os.stat(src).st_dev == os.stat(dst.parent).st_dev:
+        os.replace(src, dst)
+    else:
+        shutil.move(str(src), dst)
 
 
 # ────────── SHEETS APPEND ──────────
-def append_row(sheets_service, row):
-    sheets_service.spreadsheets().values().append(
-        spreadsheetId=SHEET_ID,
-        range=SHEET_RANGE,
-        valueInputOption="USER_ENTERED",
-        insertDataOption="INSERT_ROWS",
-        body={"values": [row]},
-    ).execute()
+def append_rows(session: AuthorizedSession, rows: List[List]) -> None:
+    """Дописывает все строки одним вызовом values.append (REST, та же сессия)."""
+    if not rows:
+        return
+    resp = session.post(
+        f"{SHEETS_VALUES_URL}/{quote(SHEET_RANGE, safe='')}:append",
+        params={"valueInputOption": "USER_ENTERED", "insertDataOption": "INSERT_ROWS"},
+        json={"values": rows},
+    )
+    resp.raise_for_status()
 
 
-# ────────── MAIN ──────────
-def main():
-    parser = argparse.ArgumentParser(description="Скачивает файлы, создаёт папку и дописывает строку.")
-    parser.add_argument("invoice_number", type=int)
-    args = parser.parse_args()
-
-    invoice_num = args.invoice_number
+# ────────── ОДИН КЕЙС ──────────
+def process_invoice(session: AuthorizedSession, invoice_num: int) -> List:
+    """
+    Скачивает PDF кейса, парсит Invoice, раскладывает файлы по папке и
+    возвращает строку для «Help Global». При ошибке — RuntimeError.
+    """
     invoice_str_padded = f"{invoice_num:08d}"
 
-    creds = get_credentials()
-    drive = build("drive", "v3", credentials=creds)
-    sheets = build("sheets", "v4", credentials=creds)
-
     # 1. Папка-кейс на Drive
-    folder_id = find_case_folder(drive, invoice_str_padded)
+    folder_id = find_case_folder(session, invoice_str_padded)
     if not folder_id:
-        sys.exit("❌ Папка-кейс на Drive не найдена.")
+        raise RuntimeError("Папка-кейс на Drive не найдена.")
 
-    # 2. Скачиваем Invoice + Grant Agreement
-    inv_meta = find_first_pdf(drive, folder_id, "Invoice")
+    # 2. Скачиваем Invoice + Grant Agreement (один list() на оба файла)
+    pdfs = list_pdfs(session, folder_id)
+    inv_meta = next(
+        (f for f in pdfs if f["name"].lower().startswith("invoice")), None
+    )
+    ga_meta = next(
+        (f for f in pdfs if f["name"].lower().startswith("grant agreement")), None
+    )
     if not inv_meta:
-        sys.exit("❌ Invoice*.pdf не найден.")
-    inv_local = download_pdf(drive, inv_meta, f"Invoice {invoice_num}.pdf")
-    print(f"⬇️  Invoice → {inv_local.name}")
+        raise RuntimeError("Invoice*.pdf не найден.")
+
+    # оба файла качаются параллельно — ждём сети, а не друг друга
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        inv_job = pool.submit(
+            download_pdf, session, inv_meta, f"Invoice {invoice_num}.pdf"
+        )
+        ga_job = (
+            pool.submit(download_pdf, session, ga_meta, ga_meta["name"])
+            if ga_meta else None
+        )
+        inv_local = inv_job.result()
+        ga_local = ga_job.result() if ga_job else None
 
-    ga_meta = find_first_pdf(drive, folder_id, "Grant Agreement")
-    ga_local = None
-    if ga_meta:
-        ga_local = download_pdf(drive, ga_meta, ga_meta["name"])
+    print(f"⬇️  Invoice → {inv_local.name}")
+    if ga_local:
         print(f"⬇️  Grant Agreement → {ga_local.name}")
     else:
         print("⚠️  Grant Agreement не найден, продолжаем без него.")
@@ -228,14 +288,12 @@ def main():
         amount = info["amount"]          # float / decimal
         case_descr = info.get("case_descr", "")
     except Exception as e:
-        sys.exit(f"❌ Ошибка парсинга Invoice: {e}")
-
-    # 4. Создаём / находим локальную папку
-    target_dir = None
-    for p in Path.cwd().iterdir():
-        if p.is_dir() and str(invoice_num) in p.name:
-            target_dir = p
-            break
+        raise RuntimeError(f"Ошибка парсинга Invoice: {e}") from e
+
+    # 4. Создаём / находим локальную папку (по метке «№<num>» из create_case_dir)
+    target_dir = next(
+        (p for p in CWD.glob(f"*№{invoice_num}*") if p.is_dir()), None
+    )
     if not target_dir:
         target_dir = create_case_dir(date_iso, amount, invoice_num)
         print(f"📁 Создана новая папка: {target_dir.name}")
@@ -243,12 +301,12 @@ def main():
         print(f"📁 Используем существующую папку: {target_dir.name}")
 
     # 5. Перемещаем PDF
-    inv_local.replace(target_dir / inv_local.name)
+    move_file(inv_local, target_dir / inv_local.name)
     if ga_local:
-        ga_local.replace(target_dir / ga_local.name)
+        move_file(ga_local, target_dir / ga_local.name)
 
-    # 6. Append to Google Sheet
-    row = [
+    # 6. Строка для Google Sheet
+    return [
         date_iso,               # A
         "",                     # B
         "",                     # C
@@ -258,14 +316,61 @@ def main():
         "", "", "", "", "",     # G-K
         "хер",                  # L
     ]
-    append_row(sheets, row)
-    print("✅ Строка успешно добавлена в «Help Global».")
+
+
+def read_batch_file(path: Path) -> List[int]:
+    """Номера инвойсов из файла: по одному в строке, # — комментарий."""
+    numbers: List[int] = []
+    for line in path.read_text(encoding="utf-8").splitlines():
+        line = line.split("#", 1)[0].strip()
+        if line:
+            numbers.append(int(line))
+    return numbers
+
+
+# ────────── MAIN ──────────
+def main():
+    parser = argparse.ArgumentParser(description="Скачивает файлы, создаёт папку и дописывает строку.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("invoice_number", type=int, nargs="?")
+    source.add_argument(
+        "--batch-file", type=Path,
+        help="файл с номерами инвойсов (по одному в строке); "
+             "все строки дописываются в таблицу одним запросом",
+    )
+    args = parser.parse_args()
+
+    creds = get_credentials()
+    session = build_session(creds)
+
+    if args.batch_file is None:
+        try:
+            row = process_invoice(session, args.invoice_number)
+        except RuntimeError as e:
+            sys.exit(f"❌ {e}")
+        append_rows(session, [row])
+        print("✅ Строка успешно добавлена в «Help Global».")
+        return
+
+    rows: List[List] = []
+    try:
+        for invoice_num in read_batch_file(args.batch_file):
+            print(f"── №{invoice_num} ──")
+            try:
+                rows.append(process_invoice(session, invoice_num))
+            except Exception as e:  # сеть, Drive, парсер — один кейс не роняет пачку
+                print(f"❌ №{invoice_num}: {e}")
+    finally:
+        # PDF уже разложены по папкам — строки готовых кейсов отправляем всегда,
+        # даже если пачку прервали (Ctrl+C)
+        append_rows(session, rows)
+        print(f"✅ Добавлено строк в «Help Global»: {len(rows)}.")
 
 
 if __name__ == "__main__":
     try:
         main()
-    except HttpError as e:
+    except requests.HTTPError as e:
         sys.exit(f"Google API error: {e}")
     except KeyboardInterrupt:
         sys.exit("\n⏹️  Прервано пользователем.")
@@ -15,19 +15,20 @@ mega_script.py  (обновлён 24-Aug-2025)
 from __future__ import annotations
 import argparse
 import io
-import re
 import shutil
 import sys
 from datetime import datetime
 from pathlib import Path
-from typing import Dict, Optional
+from typing import Dict, List, Optional
 from importlib import util as _import_util
 
-from google.auth.transport.requests import Request
+import google_auth_httplib2
+import httplib2
+import requests
+from google.auth.transport.requests import AuthorizedSession, Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
 from googleapiclient.errors import HttpError
 
 # ─────────────── GOOGLE CONSTANTS ───────────────
@@ -38,6 +39,9 @@ SCOPES = [
 ]
 SHEET_ID = "1Pr0rb89ZIsy2qiBkZAySPuEf9B_zdn58CDurhtnQm0U"
 SHEET_RANGE = "Help Global!A:L"
+PDF_PREFIXES = ("Invoice", "Grant Agreement")  # какие PDF нужны из папки-кейса
+DRIVE_FILES_URL = "https://www.googleapis.com/drive/v3/files"
+DOWNLOAD_CHUNK = 1024 * 1024  # размер куска при копировании в файл (1 MiB)
 
 # ─────────────── PATHS TO HELPERS ───────────────
 FUNCTIONS_DIR = Path(
@@ -55,10 +59,11 @@ spec.loader.exec_module(parser_Invoice)                       # type: ignore
 # ─────────────── HELPERS FOR FOLDER NAME ───────────────
 CONSTANT_TEXT = "XXX"
 FORBIDDEN = r'<>:"/\\|?*'
+_FORBIDDEN_TR = str.maketrans(dict.fromkeys(FORBIDDEN, "_"))
 
 
 def sanitize(name: str) -> str:
-    return re.sub(f"[{re.escape(FORBIDDEN)}]", "_", name).strip(" .")
+    return name.translate(_FORBIDDEN_TR).strip(" .")
 
 
 def create_case_dir(date_iso: str, amount: float, invoice_number: int) -> Path:
@@ -69,6 +74,17 @@ def create_case_dir(date_iso: str, amount: float, invoice_number: int) -> Path:
     return path
 
 
+def move_file(src: Path, dst: Path) -> None:
+    """
+    Переносит файл: на том же диске — атомарный rename (без копирования),
+    если не вышло (другой диск) — shutil.move (копия + удаление).
+    """
+    try:
+        src.replace(dst)
+    except OSError:
+        shutil.move(str(src), dst)
+
+
 # ─────────────── OAUTH ───────────────
 def get_credentials() -> Credentials:
     token_path = Path("token.json")
@@ -93,11 +109,16 @@ def get_credentials() -> Credentials:
 
 
 # ─────────────── DRIVE FUNCTIONS ───────────────
+def _q_escape(value: str) -> str:
+    """Экранирует \\ и ' для подстановки строки в q= запроса Drive."""
+    return value.replace("\\", "\\\\").replace("'", "\\'")
+
+
 def find_case_folder(service, folder_name: str) -> Optional[str]:
     query = (
         f"'{ROOT_FOLDER_ID}' in parents and "
         "mimeType='application/vnd.google-apps.folder' and "
-        f"name='{folder_name}' and trashed=false"
+        f"name='{_q_escape(folder_name)}' and trashed=false"
     )
     resp = service.files().list(
         q=query,
@@ -111,51 +132,75 @@ def find_case_folder(service, folder_name: str) -> Optional[str]:
     return files[0]["id"] if files else None
 
 
-def find_latest_pdf(service, parent_id: str, prefix: str) -> Optional[Dict]:
-    """Возвращает самый свежий PDF в папке parent_id, начинающийся с prefix."""
-    resp = service.files().list(
-        q=f"'{parent_id}' in parents and mimeType='application/pdf' and trashed=false",
-        orderBy="modifiedTime desc",
-        fields="files(id, name, modifiedTime)",
-        supportsAllDrives=True,
-        includeItemsFromAllDrives=True,
-        corpora="allDrives",
-        pageSize=100,
-    ).execute()
-
-    for f in resp.get("files", []):
-        if f["name"].lower().startswith(prefix.lower()):
-            return f
-    return None
+def list_pdfs_in_folder(service, parent_id: str) -> List[Dict]:
+    """
+    PDF в папке parent_id с «Invoice»/«Grant Agreement» в имени, от новых
+    к старым (обычно это один запрос). Фильтр по имени делает сам Drive,
+    точное совпадение префикса проверяет pick_latest.
+    """
+    name_filter = " or ".join(f"name contains '{_q_escape(p)}'" for p in PDF_PREFIXES)
+    files: List[Dict] = []
+    page_token = None
+    while True:
+        resp = service.files().list(
+            q=f"'{parent_id}' in parents and mimeType='application/pdf' and "
+              f"({name_filter}) and trashed=false",
+            orderBy="modifiedTime desc",
+            fields="nextPageToken, files(id, name, modifiedTime)",
+            supportsAllDrives=True,
+            includeItemsFromAllDrives=True,
+            corpora="allDrives",
+            pageSize=1000,
+            pageToken=page_token,
+        ).execute()
+        files.extend(resp.get("files", []))
+        page_token = resp.get("nextPageToken")
+        if not page_token:
+            return files
+
+
+def pick_latest(files: List[Dict], prefix: str) -> Optional[Dict]:
+    """Первый (самый свежий) файл из списка, имя которого начинается с prefix."""
+    return next(
+        (f for f in files if f["name"].lower().startswith(prefix.lower())), None
+    )
 
 
 def clean_filename(name: str) -> str:
-    name = re.sub(f"[{re.escape(FORBIDDEN)}]", "_", name)
-    return name.strip(" .")
+    return name.translate(_FORBIDDEN_TR).strip(" .")
 
 
-def download_pdf(service, file_meta: Dict, desired_name: str) -> Path:
+def download_pdf(session: AuthorizedSession, file_meta: Dict, desired_name: str) -> Path:
+    """Качает файл одним потоковым GET (вместо серии chunk-запросов)."""
     if not desired_name.lower().endswith(".pdf"):
         desired_name += ".pdf"
     desired_name = clean_filename(desired_name)
 
-    request = service.files().get_media(fileId=file_meta["id"])
-    with io.FileIO(desired_name, "wb") as fh:
-        downloader = MediaIoBaseDownload(fh, request)
-        done = False
-        while not done:
-            _, done = downloader.next_chunk()
+    with session.get(
+        f"{DRIVE_FILES_URL}/{file_meta['id']}",
+        params={"alt": "media", "supportsAllDrives": "true"},
+        stream=True,
+        timeout=60,
+    ) as resp:
+        resp.raise_for_status()
+        resp.raw.decode_content = True  # Drive может отдать тело в gzip
+        # FileIO без буфера Python: куски по 1 MiB сразу уходят в page cache ОС
+        with io.FileIO(desired_name, "wb") as fh:
+            shutil.copyfileobj(resp.raw, fh, DOWNLOAD_CHUNK)
     return Path(desired_name).resolve()
 
 
 # ─────────────── SHEETS APPEND ───────────────
-def append_row(service, row):
+def append_rows(service, rows: List[List]):
+    """Дописывает все строки одним вызовом values.append."""
+    if not rows:
+        return
     service.spreadsheets().values().append(
         spreadsheetId=SHEET_ID,
         range=SHEET_RANGE,
         valueInputOption="USER_ENTERED",
         insertDataOption="INSERT_ROWS",
-        body={"values": [row]},
+        body={"values": rows},
     ).execute()
 
 
@@ -169,26 +214,30 @@ def main():
     padded = f"{invoice_num:08d}"
 
     creds = get_credentials()
-    drive = build("drive", "v3", credentials=creds)
-    sheets = build("sheets", "v4", credentials=creds)
+    # один httplib2.Http на Drive и Sheets → одно TLS-соединение с keep-alive
+    authed_http = google_auth_httplib2.AuthorizedHttp(creds, http=httplib2.Http(timeout=60))
+    drive = build("drive", "v3", http=authed_http, cache_discovery=False)
+    sheets = build("sheets", "v4", http=authed_http, cache_discovery=False)
+    session = AuthorizedSession(creds)  # для скачивания файлов
 
     # 1. Папка-кейс
     folder_id = find_case_folder(drive, padded)
     if not folder_id:
         sys.exit("❌ Папка-кейс не найдена.")
 
-    # 2. PDF файлы (самые свежие)
-    inv_meta = find_latest_pdf(drive, folder_id, "Invoice")
-    ga_meta = find_latest_pdf(drive, folder_id, "Grant Agreement")
+    # 2. PDF файлы (самые свежие) — один list() на оба префикса
+    pdfs = list_pdfs_in_folder(drive, folder_id)
+    inv_meta = pick_latest(pdfs, "Invoice")
+    ga_meta = pick_latest(pdfs, "Grant Agreement")
     if not inv_meta:
         sys.exit("❌ Invoice*.pdf не найден.")
 
-    inv_local = download_pdf(drive, inv_meta, f"Invoice {invoice_num}.pdf")
+    inv_local = download_pdf(session, inv_meta, f"Invoice {invoice_num}.pdf")
     print(f"⬇️  Invoice  → {inv_local.name}")
 
     ga_local = None
     if ga_meta:
-        ga_local = download_pdf(drive, ga_meta, f"Grant Agreement {invoice_num}.pdf")
+        ga_local = download_pdf(session, ga_meta, f"Grant Agreement {invoice_num}.pdf")
         print(f"⬇️  Grant Agreement → {ga_local.name}")
     else:
         print("⚠️  Grant Agreement не найден, продолжаем без него.")
@@ -202,9 +251,9 @@ def main():
     except Exception as e:
         sys.exit(f"❌ Ошибка парсинга Invoice: {e}")
 
-    # 4. Папка на диске
-    target = next((p for p in Path.cwd().iterdir()
-                   if p.is_dir() and str(invoice_num) in p.name), None)
+    # 4. Папка на диске (по метке «№<num>» из create_case_dir)
+    target = next((p for p in Path.cwd().glob(f"*№{invoice_num}*")
+                   if p.is_dir()), None)
     if not target:
         target = create_case_dir(date_iso, amount, invoice_num)
         print(f"📁 Создана папка: {target.name}")
@@ -212,22 +261,22 @@ def main():
         print(f"📁 Папка найдена: {target.name}")
 
     # 5. Перемещаем файлы
-    shutil.move(str(inv_local), target / inv_local.name)
+    move_file(inv_local, target / inv_local.name)
     if ga_local:
-        shutil.move(str(ga_local), target / ga_local.name)
+        move_file(ga_local, target / ga_local.name)
 
     # 6. Запись в Sheets
-    append_row(sheets, [
+    append_rows(sheets, [[
         date_iso, "", "", invoice_num, case_descr, amount,
         "", "", "", "", "", "хер"
-    ])
+    ]])
     print("✅ Строка добавлена в «Help Global».")
 
 
 if __name__ == "__main__":
     try:
         main()
-    except HttpError as e:
+    except (HttpError, requests.HTTPError) as e:
         sys.exit(f"Google API error: {e}")
     except KeyboardInterrupt:
         sys.exit("\n⏹️  Прервано пользователем.")
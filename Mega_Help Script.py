@@ -2,47 +2,67 @@
 """Mega_Help Script
 ====================
 Automation script that scans Gmail for completed DocuSign cases, keeps track of
-case statuses in a local Excel file, downloads case documents from Google Drive,
+case statuses in a local CSV file, downloads case documents from Google Drive,
 parses Invoice PDFs, creates local case folders and appends rows to a Google
 Sheet. After execution a single Telegram message with a log of performed actions
 is sent.
 
 The script is designed to be idempotent – repeated runs will not duplicate
-entries in Excel or send repeated Telegram messages for already processed
+entries in the case table or send repeated Telegram messages for already processed
 cases.
 """
 
 from __future__ import annotations
 
 import base64
+import email
+import email.policy
+import hashlib
 import io
 import json
 import re
 import shutil
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass, asdict
 from datetime import datetime, timedelta
+from email.message import EmailMessage
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Any, Dict, List, Optional
 
 import argparse
 import logging
 
+import google_auth_httplib2
+import httplib2
 import pandas as pd
 import requests
-from google.auth.transport.requests import Request
+from google.auth.transport.requests import AuthorizedSession, Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
-from googleapiclient.http import MediaIoBaseDownload
+from requests.adapters import HTTPAdapter
 
 logger = logging.getLogger(__name__)
 
 # ---------------------------------------------------------------------------
 # Paths and constants
 ROOT_DIR = Path.cwd()
-CASES_XLSX = ROOT_DIR / "cases_status.xlsx"
+CASES_CSV = ROOT_DIR / "cases_status.csv"  # the script's own state
+CASES_XLSX = ROOT_DIR / "cases_status.xlsx"  # old state file / on-demand human export
+CASES_CHECKPOINT = ROOT_DIR / "cases_checkpoint.csv"  # per-case rows since last save
+CASES_COLUMNS = ["YY-MM", "case_descr", "amount", "invoice_number", "Статус"]
+# Fixed column dtypes keep per-cell writes on pandas' fast path (no object upcasts)
+CASES_DTYPES = {
+    "YY-MM": "string",
+    "case_descr": "string",
+    "amount": "Float64",
+    "invoice_number": "Int64",
+    "Статус": "string",
+}
 SEEN_JSON = ROOT_DIR / "seen_cases.json"
+SEEN_LOG = SEEN_JSON.with_suffix(".log")  # per-case flag updates since last save
 FUNCTIONS_DIR = Path(
     r"F:\Служебная\Волонтерство 4UA\ChatGPT\Автоматизация\Functions"
 )
@@ -59,14 +79,30 @@ DRIVE_SCOPES = [
     "https://www.googleapis.com/auth/drive.readonly",
     "https://www.googleapis.com/auth/spreadsheets",
 ]
+# One token covers all three APIs, so the OAuth flow runs at most once
+SCOPES = GMAIL_SCOPES + DRIVE_SCOPES
 ROOT_FOLDER_ID = "1KNvnzuBL_froKQs-JVd8TVoGDMtL4-wx"
 SHEET_ID = "1Pr0rb89ZIsy2qiBkZAySPuEf9B_zdn58CDurhtnQm0U"
 SHEET_RANGE = "Help Global!A:L"
+PDF_PREFIXES = ("Invoice", "Grant Agreement")  # case PDFs we download
+DRIVE_FILES_URL = "https://www.googleapis.com/drive/v3/files"
+DOWNLOAD_CHUNK = 1024 * 1024
+DOWNLOAD_WORKERS = 5  # concurrent downloads; kept low to stay clear of Drive 429s
+METADATA_WORKERS = 8  # concurrent folder/PDF lookups
+SEARCH_WINDOW = timedelta(days=3)  # how far back the Gmail search looks
 
 # Regex patterns
-RE_APPROVED = re.compile(r"Approved case\s*(\d{8})")
+GMAIL_BATCH_SIZE = 100  # Gmail accepts at most 100 calls per batch request
+RE_APPROVED = re.compile(r"Approved case\s*(\d{8})", re.IGNORECASE)
 RE_CASE_FOLDER = "{0:08d}"
 FORBIDDEN = r'<>:"/\\|?*'
+_FORBIDDEN_TR = str.maketrans(dict.fromkeys(FORBIDDEN, "_"))
+
+# Gmail/Sheets services shared by the whole run, see get_services()
+_services: Dict[str, Any] = {}
+
+# Per-thread Drive services: googleapiclient objects are not thread-safe
+_thread_local = threading.local()
 
 # ---------------------------------------------------------------------------
 # Data models
@@ -75,6 +111,7 @@ class CaseFlags:
     invoice_downloaded: bool = False
     grant_downloaded: bool = False
     parsed: bool = False
+    parsed_info: Optional[Dict] = None  # parse_invoice() result, reused on retries
     error: Optional[str] = None
 
 
@@ -86,57 +123,176 @@ def load_seen() -> Dict:
         with open(SEEN_JSON, "r", encoding="utf-8") as f:
             data = json.load(f)
             logger.debug("Loaded seen data from %s", SEEN_JSON)
-            return data
-    logger.debug("No seen data found, starting fresh")
-    return {"messages": [], "cases": {}}
+    else:
+        logger.debug("No seen data found, starting fresh")
+        data = {"messages": [], "cases": {}}
+    if SEEN_LOG.exists():
+        # Replay case flags logged by a run that stopped before its final save
+        with open(SEEN_LOG, "r", encoding="utf-8") as f:
+            for line in f:
+                invoice_number, _, flags = line.rstrip("\n").partition("\t")
+                try:
+                    data.setdefault("cases", {})[invoice_number] = json.loads(flags)
+                except json.JSONDecodeError:
+                    logger.debug("Skipping torn log line: %r", line)
+        logger.debug("Replayed %s", SEEN_LOG)
+    return data
 
 
 def save_seen(data: Dict) -> None:
-    with open(SEEN_JSON, "w", encoding="utf-8") as f:
+    """Atomically rewrite SEEN_JSON and clear the per-case log it supersedes."""
+    tmp_path = SEEN_JSON.with_suffix(".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
         json.dump(data, f, ensure_ascii=False, indent=2)
+    tmp_path.replace(SEEN_JSON)
+    SEEN_LOG.unlink(missing_ok=True)
     logger.debug("Saved seen data to %s", SEEN_JSON)
 
 
-def ensure_cases_excel() -> pd.DataFrame:
-    if not CASES_XLSX.exists():
-        df = pd.DataFrame(
-            columns=["YY-MM", "case_descr", "amount", "invoice_number", "Статус"]
-        )
-        df.to_excel(CASES_XLSX, index=False)
-        logger.debug("Created new Excel file %s", CASES_XLSX)
-    else:
-        df = pd.read_excel(CASES_XLSX)
-        logger.debug("Loaded existing Excel file %s", CASES_XLSX)
-    return df
+def log_case_flags(invoice_number: int, flags: Dict) -> None:
+    """Append one case's flags to SEEN_LOG instead of rewriting SEEN_JSON."""
+    with open(SEEN_LOG, "a", encoding="utf-8") as f:
+        f.write(f"{invoice_number}\t{json.dumps(flags, ensure_ascii=False)}\n")
 
 
-def save_cases_excel(df: pd.DataFrame) -> None:
-    df.to_excel(CASES_XLSX, index=False)
-    logger.debug("Saved cases dataframe to %s", CASES_XLSX)
+def load_cases() -> pd.DataFrame:
+    if CASES_CSV.exists():
+        df = pd.read_csv(CASES_CSV)
+        logger.debug("Loaded cases from %s", CASES_CSV)
+    elif CASES_XLSX.exists():
+        # One-time migration: older versions kept the state in Excel
+        df = pd.read_excel(CASES_XLSX)
+        logger.debug("Migrating cases from %s", CASES_XLSX)
+    else:
+        df = pd.DataFrame(columns=CASES_COLUMNS)
+        logger.debug("No cases file found, starting fresh")
+    if CASES_CHECKPOINT.exists():
+        # A previous run stopped before its final save: replay its rows
+        checkpoint = pd.read_csv(CASES_CHECKPOINT)
+        df = pd.concat([df, checkpoint], ignore_index=True).drop_duplicates(
+            "invoice_number", keep="last"
+        ).reset_index(drop=True)
+        logger.debug("Merged %d checkpoint rows from %s", len(checkpoint), CASES_CHECKPOINT)
+    return df.astype(CASES_DTYPES)
+
+
+def save_cases(df: pd.DataFrame) -> None:
+    """Atomically rewrite CASES_CSV and clear the checkpoint it supersedes."""
+    tmp_path = CASES_CSV.with_suffix(".tmp")
+    df.to_csv(tmp_path, index=False)
+    tmp_path.replace(CASES_CSV)
+    CASES_CHECKPOINT.unlink(missing_ok=True)
+    logger.debug("Saved cases dataframe to %s", CASES_CSV)
+
+
+def export_cases_xlsx() -> None:
+    """Write the current case table to CASES_XLSX for people to read."""
+    load_cases().to_excel(CASES_XLSX, index=False)
+    logger.info("Exported cases to %s", CASES_XLSX)
+
+
+def checkpoint_case(df: pd.DataFrame, idx: int) -> None:
+    """Append one case row to the CSV checkpoint; cheap enough to call per case."""
+    df.iloc[[idx]][CASES_COLUMNS].to_csv(
+        CASES_CHECKPOINT,
+        mode="a",
+        header=not CASES_CHECKPOINT.exists(),
+        index=False,
+    )
 
 
-def get_gmail_service() -> object:
-    logger.debug("Authorizing Gmail service")
+def get_credentials() -> Credentials:
+    """Load (or obtain) one token valid for Gmail, Drive and Sheets."""
+    logger.debug("Authorizing Google APIs")
     creds = None
     token_path = ROOT_DIR / "token.json"
     if token_path.exists():
-        creds = Credentials.from_authorized_user_file(str(token_path), GMAIL_SCOPES)
-        if creds and creds.expired and creds.refresh_token:
+        # No scopes argument: passing SCOPES would overwrite the scopes recorded
+        # in token.json and make the has_scopes() check below always pass
+        creds = Credentials.from_authorized_user_file(str(token_path))
+        # A token issued for a narrower scope set has to be re-authorized
+        if not creds.has_scopes(SCOPES):
+            creds = None
+        elif creds.expired and creds.refresh_token:
             creds.refresh(Request())
+            token_path.write_text(creds.to_json(), encoding="utf-8")
     if not creds or not creds.valid:
         flow = InstalledAppFlow.from_client_secrets_file(
-            str(ROOT_DIR / "client_secret.json"), GMAIL_SCOPES
+            str(ROOT_DIR / "client_secret.json"), SCOPES
         )
         creds = flow.run_local_server(port=0)
         token_path.write_text(creds.to_json(), encoding="utf-8")
-    service = build("gmail", "v1", credentials=creds, cache_discovery=False)
-    logger.debug("Gmail service initialized")
-    return service
+    return creds
+
+
+def get_services() -> Dict[str, Any]:
+    """Build the Gmail and Sheets services once and reuse them.
+
+    Both share one authorized ``httplib2.Http``, so their calls to
+    googleapis.com reuse a single keep-alive connection. Also exposes the
+    shared ``creds`` for helpers that talk to the APIs directly; Drive
+    lookups run in worker threads and use get_thread_drive() instead.
+    """
+    if not _services:
+        creds = get_credentials()
+        http = google_auth_httplib2.AuthorizedHttp(creds, http=httplib2.Http(timeout=60))
+        _services.update(
+            creds=creds,
+            gmail=build("gmail", "v1", http=http, cache_discovery=False),
+            sheets=build("sheets", "v4", http=http, cache_discovery=False),
+        )
+        logger.debug("Google services initialized")
+    return _services
+
+
+def get_messages_batched(service, msg_ids: List[str], **params) -> Dict[str, Dict]:
+    """Fetch ``messages.get`` for every id using batch requests of up to 100 calls."""
+    messages: Dict[str, Dict] = {}
+
+    def on_response(request_id, response, exception):
+        if exception is not None:
+            logger.error("Gmail get failed for %s: %s", request_id, exception)
+            return
+        messages[request_id] = response
+
+    for start in range(0, len(msg_ids), GMAIL_BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=on_response)
+        for msg_id in msg_ids[start:start + GMAIL_BATCH_SIZE]:
+            batch.add(
+                service.users().messages().get(userId="me", id=msg_id, **params),
+                request_id=msg_id,
+            )
+        batch.execute()
+    return messages
+
+
+def parse_raw_message(raw: str) -> EmailMessage:
+    """Decode a ``format="raw"`` Gmail message into an ``EmailMessage``."""
+    return email.message_from_bytes(base64.urlsafe_b64decode(raw), policy=email.policy.default)
+
+
+def plain_text_body(msg: EmailMessage) -> str:
+    """Join the text of every ``text/plain`` part of ``msg``."""
+    return "\n".join(
+        part.get_content() for part in msg.walk() if part.get_content_type() == "text/plain"
+    )
+
+
+def content_hash(sender: str, subject: str, invoice_number: int) -> str:
+    """Identify a DocuSign event independently of the Gmail message id."""
+    key = f"{sender}\0{subject}\0{invoice_number}"
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=16).hexdigest()
 
 
-def search_new_messages(service, seen_ids: set[str]) -> List[tuple[str, int]]:
+def search_new_messages(
+    service, seen_ids: set[str]
+) -> tuple[List[tuple[str, int, str]], set[str]]:
+    """Return ``(msg_id, invoice_number, content_hash)`` for new approved cases.
+
+    Also returns the ids of every message the search matched, seen or not.
+    """
     kyiv_now = datetime.now()
-    after = (kyiv_now - timedelta(days=3)).strftime("%Y/%m/%d")
+    after = (kyiv_now - SEARCH_WINDOW).strftime("%Y/%m/%d")
     query = (
         "from:docusign.net "
         "subject:(Завершен OR Завершён) "
@@ -145,60 +301,69 @@ def search_new_messages(service, seen_ids: set[str]) -> List[tuple[str, int]]:
     )
     logger.debug("Gmail search query: %s", query)
     resp = service.users().messages().list(userId="me", q=query).execute()
-    results = []
-    subjects: List[str] = []
-    for msg in resp.get("messages", []):
-        msg_id = msg["id"]
-        if msg_id in seen_ids:
+    listed_ids = [m["id"] for m in resp.get("messages", [])]
+    new_ids = [msg_id for msg_id in listed_ids if msg_id not in seen_ids]
+    # Subjects only first; the body is fetched just for messages whose subject
+    # does not carry the case number.
+    fetched = get_messages_batched(
+        service,
+        new_ids,
+        format="metadata",
+        metadataHeaders=["Subject", "From"],
+        fields="payload/headers",
+    )
+    found: Dict[str, int] = {}
+    body_needed: List[str] = []
+    subjects: Dict[str, str] = {}
+    senders: Dict[str, str] = {}
+    for msg_id in new_ids:
+        meta = fetched.get(msg_id)
+        if meta is None:
             continue
-        full = service.users().messages().get(
-            userId="me", id=msg_id, format="full"
-        ).execute()
-        headers = full.get("payload", {}).get("headers", [])
-        subject = next((h["value"] for h in headers if h["name"] == "Subject"), "")
-        subjects.append(subject)
+        headers = {h["name"]: h["value"] for h in meta.get("payload", {}).get("headers", [])}
+        subject = subjects[msg_id] = headers.get("Subject", "")
+        senders[msg_id] = headers.get("From", "")
         logger.debug("Checking message %s with subject: %s", msg_id, subject)
-        body_data = full.get("payload", {}).get("body", {}).get("data")
-        body = ""
-        if body_data:
-            body = base64.urlsafe_b64decode(body_data).decode("utf-8", errors="ignore")
-        full_text = subject + "\n" + body
-        m = RE_APPROVED.search(full_text)
-        if not m:
-            continue
-        results.append((msg_id, int(m.group(1))))
-    logger.info("Email subjects checked: %s", subjects)
-    return results
+        m = RE_APPROVED.search(subject)
+        if m:
+            found[msg_id] = int(m.group(1))
+        else:
+            body_needed.append(msg_id)
 
+    if body_needed:
+        bodies = get_messages_batched(service, body_needed, format="raw", fields="raw")
+        for msg_id, raw in bodies.items():
+            body = plain_text_body(parse_raw_message(raw["raw"]))
+            m = RE_APPROVED.search(body)
+            if m:
+                found[msg_id] = int(m.group(1))
 
-def get_drive_service() -> tuple[object, Credentials]:
-    logger.debug("Authorizing Drive service")
-    token_path = ROOT_DIR / "token.json"
-    creds = None
-    if token_path.exists():
-        creds = Credentials.from_authorized_user_file(str(token_path), DRIVE_SCOPES)
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-    if not creds or not creds.valid:
-        flow = InstalledAppFlow.from_client_secrets_file(
-            str(ROOT_DIR / "client_secret.json"), DRIVE_SCOPES
-        )
-        creds = flow.run_local_server(port=0)
-        token_path.write_text(creds.to_json(), encoding="utf-8")
-    service = build("drive", "v3", credentials=creds)
-    logger.debug("Drive service initialized")
-    return service, creds
+    results = [
+        (msg_id, found[msg_id], content_hash(senders[msg_id], subjects[msg_id], found[msg_id]))
+        for msg_id in new_ids
+        if msg_id in found
+    ]
+    logger.info("Email subjects checked: %s", list(subjects.values()))
+    return results, set(listed_ids)
+
+
+def get_drive_session(creds: Credentials) -> AuthorizedSession:
+    """Authorized HTTP session with a connection pool sized for the download pool."""
+    session = AuthorizedSession(creds)
+    session.mount("https://", HTTPAdapter(pool_maxsize=DOWNLOAD_WORKERS))
+    return session
 
 
-def get_sheets_service(creds) -> object:
-    return build("sheets", "v4", credentials=creds)
+def _q_escape(value: str) -> str:
+    """Escape backslashes and single quotes for a Drive ``q`` string literal."""
+    return value.replace("\\", "\\\\").replace("'", "\\'")
 
 
 def find_case_folder(service, padded: str) -> Optional[str]:
     query = (
         f"'{ROOT_FOLDER_ID}' in parents and "
         "mimeType='application/vnd.google-apps.folder' and "
-        f"name='{padded}' and trashed=false"
+        f"name='{_q_escape(padded)}' and trashed=false"
     )
     logger.debug("Searching for case folder with query: %s", query)
     resp = service.files().list(
@@ -215,43 +380,98 @@ def find_case_folder(service, padded: str) -> Optional[str]:
     return folder_id
 
 
-def find_latest_pdf(service, parent_id: str, prefix: str) -> Optional[Dict]:
-    logger.debug("Searching for PDF starting with '%s' in folder %s", prefix, parent_id)
-    resp = service.files().list(
-        q=f"'{parent_id}' in parents and mimeType='application/pdf' and trashed=false",
-        orderBy="modifiedTime desc",
-        fields="files(id, name)",
-        supportsAllDrives=True,
-        includeItemsFromAllDrives=True,
-        corpora="allDrives",
-        pageSize=100,
-    ).execute()
-    for f in resp.get("files", []):
-        if f["name"].lower().startswith(prefix.lower()):
-            logger.debug("Found PDF: %s", f)
-            return f
-    logger.debug("No PDF found for prefix %s", prefix)
-    return None
+def list_pdfs_in_folder(service, parent_id: str) -> List[Dict]:
+    """Return the Invoice/Grant Agreement PDFs in ``parent_id``, newest first.
+
+    Drive filters by name server-side; ``pick_latest`` still checks the exact
+    prefix because ``name contains`` also matches words later in the name.
+    """
+    logger.debug("Listing PDFs in folder %s", parent_id)
+    name_filter = " or ".join(f"name contains '{_q_escape(p)}'" for p in PDF_PREFIXES)
+    files: List[Dict] = []
+    page_token = None
+    while True:
+        resp = service.files().list(
+            q=f"'{parent_id}' in parents and mimeType='application/pdf' and "
+              f"({name_filter}) and trashed=false",
+            orderBy="modifiedTime desc",
+            fields="nextPageToken, files(id, name, modifiedTime)",
+            supportsAllDrives=True,
+            includeItemsFromAllDrives=True,
+            corpora="allDrives",
+            pageSize=1000,
+            pageToken=page_token,
+        ).execute()
+        files.extend(resp.get("files", []))
+        page_token = resp.get("nextPageToken")
+        if not page_token:
+            break
+    logger.debug("Found %d PDFs", len(files))
+    return files
+
+
+def pick_latest(files: List[Dict], prefix: str) -> Optional[Dict]:
+    """Return the newest file from ``files`` whose name starts with ``prefix``."""
+    found = next(
+        (f for f in files if f["name"].lower().startswith(prefix.lower())), None
+    )
+    logger.debug("Latest PDF for prefix %s: %s", prefix, found)
+    return found
+
+
+def get_thread_drive(creds: Credentials) -> object:
+    """Return the Drive service owned by the current thread, building it once."""
+    drive = getattr(_thread_local, "drive", None)
+    if drive is None:
+        drive = build("drive", "v3", credentials=creds, cache_discovery=False)
+        _thread_local.drive = drive
+    return drive
+
+
+def resolve_case_metadata(
+    creds: Credentials, invoice_number: int
+) -> tuple[str, Optional[Dict], Optional[Dict]]:
+    """Return ``(folder_id, invoice_meta, grant_meta)`` for a case.
+
+    Uses the calling thread's own Drive service, so it can run in a pool.
+    """
+    drive = get_thread_drive(creds)
+    folder_id = find_case_folder(drive, RE_CASE_FOLDER.format(invoice_number))
+    if not folder_id:
+        raise RuntimeError("Папка-кейс не найдена")
+    pdfs = list_pdfs_in_folder(drive, folder_id)
+    return folder_id, pick_latest(pdfs, "Invoice"), pick_latest(pdfs, "Grant Agreement")
 
 
 def clean_filename(name: str) -> str:
-    return re.sub(f"[{re.escape(FORBIDDEN)}]", "_", name).strip(" .")
+    return name.translate(_FORBIDDEN_TR).strip(" .")
 
 
-def download_pdf(service, file_meta: Dict, desired_name: str) -> Path:
+def download_pdf(session: AuthorizedSession, file_meta: Dict, desired_name: str) -> Path:
+    """Stream a Drive file to ``desired_name`` with one GET; safe to run in threads."""
     if not desired_name.lower().endswith(".pdf"):
         desired_name += ".pdf"
     desired_name = clean_filename(desired_name)
     logger.debug("Downloading %s to %s", file_meta.get("name"), desired_name)
-    request = service.files().get_media(fileId=file_meta["id"])
-    fh = io.FileIO(desired_name, "wb")
-    downloader = MediaIoBaseDownload(fh, request)
-    done = False
-    while not done:
-        _, done = downloader.next_chunk()
-    fh.close()
-    logger.debug("Downloaded file saved as %s", desired_name)
-    return Path(desired_name)
+    path = ROOT_DIR / desired_name
+    with session.get(
+        f"{DRIVE_FILES_URL}/{file_meta['id']}",
+        params={"alt": "media", "supportsAllDrives": "true"},
+        stream=True,
+        timeout=60,
+    ) as resp:
+        resp.raise_for_status()
+        resp.raw.decode_content = True  # Drive may gzip the body
+        with io.FileIO(path, "wb") as fh:
+            shutil.copyfileobj(resp.raw, fh, DOWNLOAD_CHUNK)
+    logger.debug("Downloaded file saved as %s", path)
+    return path
+
+
+def cached_download(flags: Dict, flag: str, name: str) -> Optional[Path]:
+    """Return the file a previous run already downloaded, if it is still there."""
+    path = ROOT_DIR / clean_filename(name)
+    return path if flags.get(flag) and path.exists() else None
 
 
 def load_parser():
@@ -277,14 +497,25 @@ def create_case_dir(date_iso: str, amount: float, invoice_number: int) -> Path:
     return path
 
 
-def append_row(sheets, row: List) -> None:
-    logger.debug("Appending row to sheet: %s", row)
+def move_file(src: Path, dst: Path) -> None:
+    """Rename ``src`` to ``dst``; fall back to copy+delete across drives."""
+    try:
+        src.replace(dst)
+    except OSError:
+        shutil.move(str(src), dst)
+
+
+def append_rows(sheets, rows: List[List]) -> None:
+    """Append all ``rows`` to the sheet with a single values.append call."""
+    if not rows:
+        return
+    logger.debug("Appending %d rows to sheet", len(rows))
     sheets.spreadsheets().values().append(
         spreadsheetId=SHEET_ID,
         range=SHEET_RANGE,
         valueInputOption="USER_ENTERED",
         insertDataOption="INSERT_ROWS",
-        body={"values": [row]},
+        body={"values": rows},
     ).execute()
 
 
@@ -309,97 +540,192 @@ def process():
     parser_module = load_parser()
     logger.debug("Parser module ready")
 
-    cases_df = ensure_cases_excel()
+    cases_df = load_cases()
     logger.debug("Cases dataframe loaded with %d rows", len(cases_df))
     seen_data = load_seen()
     logger.debug("Seen data: %s", seen_data)
     seen_msgs = set(seen_data.get("messages", []))
+    # The same DocuSign event can arrive under several message ids
+    # (re-delivery, a second inbox), so events are also deduplicated by content.
+    # Each hash maps to the date it was first seen; hashes older than the search
+    # window can never match again and are dropped so the file stays bounded.
+    today = datetime.now().date()
+    cutoff = (today - SEARCH_WINDOW).isoformat()
+    stored_hashes = seen_data.get("case_hashes", {})
+    if isinstance(stored_hashes, list):  # older seen_cases.json: plain list
+        stored_hashes = dict.fromkeys(stored_hashes, today.isoformat())
+    case_hashes = {h: day for h, day in stored_hashes.items() if day >= cutoff}
 
     # 1. Gmail
     try:
         logger.info("Connecting to Gmail and searching for new messages")
-        gmail = get_gmail_service()
-        new_msgs = search_new_messages(gmail, seen_msgs)
+        gmail = get_services()["gmail"]
+        new_msgs, listed_ids = search_new_messages(gmail, seen_msgs)
         logger.info("New messages found: %d", len(new_msgs))
+        # Ids older than the search window can never be listed again: keeping
+        # only the listed ones stops seen_cases.json from growing every run
+        seen_msgs &= listed_ids
     except Exception as e:
         new_msgs = []
         telegram_log.append(f"❌ Gmail error: {e}")
         logger.error("Gmail error: %s", e)
 
-    for msg_id, inv_no in new_msgs:
+    existing_invoices = set(cases_df["invoice_number"].dropna().astype(int))
+    new_rows: List[Dict] = []
+    for msg_id, inv_no, msg_hash in new_msgs:
+        seen_msgs.add(msg_id)
+        if msg_hash in case_hashes:
+            logger.debug("Message %s repeats an already seen event, skipping", msg_id)
+            continue
+        case_hashes[msg_hash] = today.isoformat()
         logger.debug("Processing message %s for invoice %s", msg_id, inv_no)
-        if str(inv_no) not in cases_df["invoice_number"].astype(str).tolist():
-            new_row = {
-                "YY-MM": "",
-                "case_descr": "",
-                "amount": "",
-                "invoice_number": int(inv_no),
-                "Статус": "Ожидает Invoice",
-            }
-            cases_df = pd.concat([cases_df, pd.DataFrame([new_row])], ignore_index=True)
+        if int(inv_no) not in existing_invoices:
+            new_rows.append(
+                {
+                    "YY-MM": "",
+                    "case_descr": "",
+                    "amount": None,
+                    "invoice_number": int(inv_no),
+                    "Статус": "Ожидает Invoice",
+                }
+            )
+            existing_invoices.add(int(inv_no))
             logger.debug("Added new row for invoice %s", inv_no)
         telegram_log.append(f"📬 Найдено письмо: №{int(inv_no)}")
-        seen_msgs.add(msg_id)
         seen_data.setdefault("cases", {}).setdefault(str(inv_no), asdict(CaseFlags()))
+    if new_rows:
+        cases_df = pd.concat(
+            [cases_df, pd.DataFrame(new_rows).astype(CASES_DTYPES)], ignore_index=True
+        )
 
     # Save initial data after Gmail stage
     logger.debug("Saving state after Gmail stage")
-    save_cases_excel(cases_df)
+    save_cases(cases_df)
     seen_data["messages"] = list(seen_msgs)
+    seen_data["case_hashes"] = case_hashes
     save_seen(seen_data)
 
     # 2. Process cases
     logger.info("Processing cases")
-    drive, creds = get_drive_service()
-    sheets = build("sheets", "v4", credentials=creds)
+    services = get_services()
+    creds, sheets = services["creds"], services["sheets"]
+    session = get_drive_session(creds)
+    # Sheet rows are flushed in one append after the loop; the matching cases
+    # are marked "Готово" only once that append succeeds.
+    pending_sheet_rows: List[List] = []
+    pending_cases: List[tuple[int, int]] = []  # (dataframe index, invoice number)
+
+    # 2a. Resolve every pending case on Drive concurrently
+    # cases_df has a RangeIndex, so row positions double as iat/iloc indices
+    status_col = cases_df.columns.get_loc("Статус")
+    yy_mm_col, descr_col, amount_col = (
+        cases_df.columns.get_loc(c) for c in ("YY-MM", "case_descr", "amount")
+    )
+    pending = [
+        (idx, int(inv))
+        for idx, (inv, status) in enumerate(
+            zip(cases_df["invoice_number"].to_numpy(), cases_df["Статус"].to_numpy())
+        )
+        if str(status) != "Готово"
+    ]
+    logger.info("Pending cases: %d", len(pending))
+
+    # Sub-steps finished by an earlier run are not repeated: a cached parse
+    # result or files still lying in ROOT_DIR let a retry skip Drive entirely.
+    done_steps: List[tuple[Optional[Dict], Optional[Path], Optional[Path]]] = []
+    for _, invoice_number in pending:
+        flags = seen_data.get("cases", {}).get(str(invoice_number), {})
+        done_steps.append(
+            (
+                flags.get("parsed_info") if flags.get("parsed") else None,
+                cached_download(flags, "invoice_downloaded", f"Invoice {invoice_number}.pdf"),
+                cached_download(
+                    flags, "grant_downloaded", f"Grant Agreement {invoice_number}.pdf"
+                ),
+            )
+        )
 
-    for idx, row in cases_df.iterrows():
-        status = str(row.get("Статус", ""))
-        if status == "Готово":
-            logger.debug("Skipping invoice %s - already done", row["invoice_number"])
-            continue
-        invoice_number = int(row["invoice_number"])
-        logger.info("Processing invoice %s", invoice_number)
-        case_flags = seen_data.get("cases", {}).get(str(invoice_number), asdict(CaseFlags()))
-        padded = RE_CASE_FOLDER.format(invoice_number)
+    def lookup(item: tuple) -> tuple[Optional[tuple], Optional[Exception]]:
+        invoice_number, (info, inv_local, grant_local) = item
+        if info or (inv_local and grant_local):
+            return None, None
         try:
-            folder_id = find_case_folder(drive, padded)
-            if not folder_id:
-                raise RuntimeError("Папка-кейс не найдена")
-            invoice_meta = find_latest_pdf(drive, folder_id, "Invoice")
-            grant_meta = find_latest_pdf(drive, folder_id, "Grant Agreement")
-            inv_path = grant_path = None
-            if invoice_meta:
-                inv_path = download_pdf(
-                    drive, invoice_meta, f"Invoice {invoice_number}.pdf"
+            return resolve_case_metadata(creds, invoice_number), None
+        except Exception as e:
+            return None, e
+
+    with ThreadPoolExecutor(max_workers=METADATA_WORKERS) as pool:
+        lookups = list(pool.map(lookup, zip((inv for _, inv in pending), done_steps)))
+
+    # 2b. Download the case files concurrently
+    queued: List[tuple] = []
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as pool:
+        for (idx, invoice_number), (metadata, lookup_error), done in zip(
+            pending, lookups, done_steps
+        ):
+            info, inv_local, grant_local = done
+            inv_future = grant_future = None
+            if metadata and not info:
+                _, invoice_meta, grant_meta = metadata
+                if invoice_meta and not inv_local:
+                    inv_future = pool.submit(
+                        download_pdf, session, invoice_meta, f"Invoice {invoice_number}.pdf"
+                    )
+                if grant_meta and not grant_local:
+                    grant_future = pool.submit(
+                        download_pdf,
+                        session,
+                        grant_meta,
+                        f"Grant Agreement {invoice_number}.pdf",
+                    )
+            queued.append(
+                (
+                    idx,
+                    invoice_number,
+                    lookup_error,
+                    info,
+                    inv_future or inv_local,
+                    grant_future or grant_local,
                 )
+            )
+
+    # 2c. Parse invoices and build case folders from the downloaded files
+    for idx, invoice_number, lookup_error, info, inv_src, grant_src in queued:
+        case_flags = seen_data.get("cases", {}).get(str(invoice_number), asdict(CaseFlags()))
+        try:
+            if lookup_error:
+                raise lookup_error
+            inv_path, grant_path = inv_src, grant_src
+            if isinstance(inv_src, Future):
+                inv_path = inv_src.result()
                 telegram_log.append(f"📥 скачан файл: {inv_path.name}")
                 case_flags["invoice_downloaded"] = True
-            if grant_meta:
-                grant_path = download_pdf(
-                    drive, grant_meta, f"Grant Agreement {invoice_number}.pdf"
-                )
+                log_case_flags(invoice_number, case_flags)
+            if isinstance(grant_src, Future):
+                grant_path = grant_src.result()
                 telegram_log.append(f"📥 скачан файл: {grant_path.name}")
                 case_flags["grant_downloaded"] = True
-
-            if inv_path:
-                info: Dict = parser_module.parse_invoice(str(inv_path))
-                logger.debug("Parsed invoice info: %s", info)
+                log_case_flags(invoice_number, case_flags)
+
+            if info or inv_path:
+                if info is None:
+                    info = parser_module.parse_invoice(str(inv_path))
+                    logger.debug("Parsed invoice info: %s", info)
+                    telegram_log.append("📊 Invoice распарсен")
+                    case_flags["parsed"] = True
+                    case_flags["parsed_info"] = info
+                    log_case_flags(invoice_number, case_flags)
                 yy_mm = datetime.fromisoformat(info["date"]).strftime("%y-%m")
-                cases_df.loc[idx, ["YY-MM", "case_descr", "amount"]] = [
-                    yy_mm,
-                    info.get("case_descr", ""),
-                    info.get("amount", ""),
-                ]
-                telegram_log.append("📊 Invoice распарсен")
-                case_flags["parsed"] = True
+                cases_df.iat[idx, yy_mm_col] = yy_mm
+                cases_df.iat[idx, descr_col] = info.get("case_descr", "")
+                cases_df.iat[idx, amount_col] = float(info["amount"])
                 target_dir = create_case_dir(info["date"], info["amount"], invoice_number)
-                shutil.move(str(inv_path), target_dir / inv_path.name)
+                if inv_path:
+                    move_file(inv_path, target_dir / inv_path.name)
                 if grant_path:
-                    shutil.move(str(grant_path), target_dir / grant_path.name)
+                    move_file(grant_path, target_dir / grant_path.name)
                 telegram_log.append("📂 Папка сформирована")
-                append_row(
-                    sheets,
+                pending_sheet_rows.append(
                     [
                         info["date"],
                         "",
@@ -413,26 +739,44 @@ def process():
                         "",
                         "",
                         "хер",
-                    ],
+                    ]
                 )
-                telegram_log.append("📊 Добавлено в таблицу")
-                cases_df.loc[idx, "Статус"] = "Готово"
-                telegram_log.append(f"✅ Кейс №{invoice_number} обработан")
+                pending_cases.append((idx, invoice_number))
             else:
-                cases_df.loc[idx, "Статус"] = "Ошибка: Invoice не найден"
+                cases_df.iat[idx, status_col] = "Ошибка: Invoice не найден"
                 telegram_log.append(
                     f"❌ Ошибка кейса №{invoice_number}: Invoice не найден"
                 )
                 case_flags["error"] = "Invoice not found"
         except Exception as e:
-            cases_df.loc[idx, "Статус"] = f"Ошибка: {e}"
+            cases_df.iat[idx, status_col] = f"Ошибка: {e}"
             telegram_log.append(f"❌ Ошибка кейса №{invoice_number}: {e}")
             case_flags["error"] = str(e)
             logger.error("Error processing invoice %s: %s", invoice_number, e)
         finally:
             seen_data.setdefault("cases", {})[str(invoice_number)] = case_flags
-            save_cases_excel(cases_df)
-            save_seen(seen_data)
+            checkpoint_case(cases_df, idx)
+            log_case_flags(invoice_number, case_flags)
+
+    # 3. Sheets
+    if pending_sheet_rows:
+        try:
+            append_rows(sheets, pending_sheet_rows)
+        except Exception as e:
+            logger.error("Sheets append failed: %s", e)
+            telegram_log.append(f"❌ Ошибка Sheets: {e}")
+            for idx, invoice_number in pending_cases:
+                cases_df.iat[idx, status_col] = "Ошибка: Sheets"
+                seen_data["cases"][str(invoice_number)]["error"] = f"Sheets: {e}"
+        else:
+            telegram_log.append(f"📊 Добавлено в таблицу: {len(pending_sheet_rows)}")
+            for idx, invoice_number in pending_cases:
+                cases_df.iat[idx, status_col] = "Готово"
+                telegram_log.append(f"✅ Кейс №{invoice_number} обработан")
+
+    # The case table is written once per run; the checkpoint covers crashes
+    save_cases(cases_df)
+    save_seen(seen_data)
 
     send_telegram(telegram_log)
     logger.info("Processing finished")
@@ -441,12 +785,20 @@ def process():
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Mega_Help Script")
     parser.add_argument("--debug", action="store_true", help="Enable debug output")
+    parser.add_argument(
+        "--export-xlsx",
+        action="store_true",
+        help=f"Only write the case table to {CASES_XLSX.name} and exit",
+    )
     args = parser.parse_args()
     logging.basicConfig(
         level=logging.DEBUG if args.debug else logging.INFO,
         format="%(asctime)s - %(levelname)s - %(message)s",
     )
-    try:
-        process()
-    except HttpError as e:
-        logger.error("Google API error: %s", e)
+    if args.export_xlsx:
+        export_cases_xlsx()
+    else:
+        try:
+            process()
+        except HttpError as e:
+            logger.error("Google API error: %s", e)
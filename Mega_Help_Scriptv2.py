@@ -2,42 +2,61 @@
 """Mega_Help Script
 ====================
 Automation script that scans Gmail for completed DocuSign cases, keeps track of
-case statuses in a local Excel file, downloads case documents from Google Drive,
+case statuses in a local CSV file, downloads case documents from Google Drive,
 parses Invoice PDFs, creates local case folders and appends rows to a Google
 Sheet. After execution a single Telegram message with a log of performed actions
 is sent.
 
 The script is designed to be idempotent – repeated runs will not duplicate
-entries in Excel or send repeated Telegram messages for already processed
+entries in the case table or send repeated Telegram messages for already processed
 cases.
 """
 
 from __future__ import annotations
 
+import argparse
+import atexit
 import base64
+import email
+import email.policy
 import io
 import json
+import os
 import re
 import shutil
-from dataclasses import dataclass, asdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, asdict, field
 from datetime import datetime, timedelta
+from functools import lru_cache
+from email.message import EmailMessage
 from pathlib import Path
 from typing import Dict, List, Optional
 
+import google_auth_httplib2
+import httplib2
 import pandas as pd
 import requests
-from google.auth.transport.requests import Request
+from google.auth.transport.requests import AuthorizedSession, Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
-from googleapiclient.http import MediaIoBaseDownload
+from requests.adapters import HTTPAdapter
 
 # ---------------------------------------------------------------------------
 # Paths and constants
 ROOT_DIR = Path.cwd()
-CASES_XLSX = ROOT_DIR / "cases_status.xlsx"
+CASES_CSV = ROOT_DIR / "cases_status.csv"  # the script's own state
+CASES_XLSX = ROOT_DIR / "cases_status.xlsx"  # old state file / on-demand human export
 SEEN_JSON = ROOT_DIR / "seen_cases.json"
+# Fixed column dtypes keep per-cell writes on pandas' fast path (no object upcasts)
+CASES_DTYPES = {
+    "YY-MM": "string",
+    "case_descr": "string",
+    "amount": "Float64",
+    "invoice_number": "Int64",
+    "Статус": "string",
+}
 FUNCTIONS_DIR = Path(
     r"F:\Служебная\Волонтерство 4UA\ChatGPT\Автоматизация\Functions"
 )
@@ -54,14 +73,25 @@ DRIVE_SCOPES = [
     "https://www.googleapis.com/auth/drive.readonly",
     "https://www.googleapis.com/auth/spreadsheets",
 ]
+# One token covers all three APIs, so token.json is read once per run
+SCOPES = GMAIL_SCOPES + DRIVE_SCOPES
 ROOT_FOLDER_ID = "1KNvnzuBL_froKQs-JVd8TVoGDMtL4-wx"
 SHEET_ID = "1Pr0rb89ZIsy2qiBkZAySPuEf9B_zdn58CDurhtnQm0U"
 SHEET_RANGE = "Help Global!A:L"
+DRIVE_FILES_URL = "https://www.googleapis.com/drive/v3/files"
+DOWNLOAD_CHUNK = 1024 * 1024
+DOWNLOAD_WORKERS = 8  # concurrent Drive downloads
+
+DRIVE_QUERY_CHUNK = 50  # names/parents OR-ed into one files.list query
+GMAIL_BATCH_SIZE = 100  # Gmail accepts at most 100 calls per batch request
 
 # Regex patterns
 RE_APPROVED = re.compile(r"Approved case\s*(\d{8})")
 RE_CASE_FOLDER = "{0:08d}"
 FORBIDDEN = r'<>:"/\\|?*'
+_FORBIDDEN_TR = str.maketrans(dict.fromkeys(FORBIDDEN, "_"))
+# CaseFlags field recording that a case PDF of this kind was downloaded
+DOWNLOAD_FLAGS = {"Invoice": "invoice_downloaded", "Grant Agreement": "grant_downloaded"}
 
 # ---------------------------------------------------------------------------
 # Data models
@@ -70,53 +100,149 @@ class CaseFlags:
     invoice_downloaded: bool = False
     grant_downloaded: bool = False
     parsed: bool = False
+    parsed_info: Optional[Dict] = None  # parse_invoice() result, reused on retries
     error: Optional[str] = None
 
 
+@dataclass
+class SeenState:
+    """Contents of SEEN_JSON plus a flag telling whether they need saving."""
+
+    messages: set[str] = field(default_factory=set)
+    cases: Dict[str, Dict] = field(default_factory=dict)
+    dirty: bool = False
+
+    def add_message(self, msg_id: str) -> None:
+        if msg_id not in self.messages:
+            self.messages.add(msg_id)
+            self.dirty = True
+
+    def ensure_case(self, invoice_number: int) -> None:
+        if str(invoice_number) not in self.cases:
+            self.cases[str(invoice_number)] = asdict(CaseFlags())
+            self.dirty = True
+
+    def set_case(self, invoice_number: int, flags: Dict) -> None:
+        self.cases[str(invoice_number)] = flags
+        self.dirty = True
+
+
 # ---------------------------------------------------------------------------
 # Utility functions
 
-def load_seen() -> Dict:
+def load_seen() -> SeenState:
     if SEEN_JSON.exists():
         with open(SEEN_JSON, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return {"messages": [], "cases": {}}
+            data = json.load(f)
+        return SeenState(set(data.get("messages", [])), data.get("cases", {}))
+    return SeenState()
 
 
-def save_seen(data: Dict) -> None:
-    with open(SEEN_JSON, "w", encoding="utf-8") as f:
+def save_seen(seen: SeenState) -> None:
+    """Atomically rewrite SEEN_JSON; does nothing if ``seen`` is unchanged."""
+    if not seen.dirty:
+        return
+    data = {"messages": sorted(seen.messages), "cases": seen.cases}
+    tmp_path = SEEN_JSON.with_suffix(".json.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
         json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, SEEN_JSON)
+    seen.dirty = False
 
 
-def ensure_cases_excel() -> pd.DataFrame:
-    if not CASES_XLSX.exists():
-        df = pd.DataFrame(
-            columns=["YY-MM", "case_descr", "amount", "invoice_number", "Статус"]
-        )
-        df.to_excel(CASES_XLSX, index=False)
-    else:
+def load_cases() -> pd.DataFrame:
+    if CASES_CSV.exists():
+        df = pd.read_csv(CASES_CSV)
+    elif CASES_XLSX.exists():
+        # One-time migration: older versions kept the state in Excel
         df = pd.read_excel(CASES_XLSX)
-    return df
+    else:
+        df = pd.DataFrame(columns=list(CASES_DTYPES))
+    return df.astype(CASES_DTYPES)
 
 
-def save_cases_excel(df: pd.DataFrame) -> None:
-    df.to_excel(CASES_XLSX, index=False)
+def save_cases(df: pd.DataFrame) -> None:
+    """Atomically rewrite CASES_CSV."""
+    tmp_path = CASES_CSV.with_suffix(".tmp")
+    df.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, CASES_CSV)
 
 
-def get_gmail_service() -> object:
+def export_cases_xlsx() -> None:
+    """Write the current case table to CASES_XLSX for people to read."""
+    load_cases().to_excel(CASES_XLSX, index=False)
+    print(f"Exported cases to {CASES_XLSX}")
+
+
+@lru_cache(maxsize=1)
+def get_credentials() -> Credentials:
+    """Load (or obtain) one token valid for Gmail, Drive and Sheets, once per run."""
     creds = None
     token_path = ROOT_DIR / "token.json"
     if token_path.exists():
-        creds = Credentials.from_authorized_user_file(str(token_path), GMAIL_SCOPES)
-        if creds and creds.expired and creds.refresh_token:
+        # No scopes argument: passing SCOPES would overwrite the scopes recorded
+        # in token.json and make the has_scopes() check below always pass
+        creds = Credentials.from_authorized_user_file(str(token_path))
+        # A token issued for a narrower scope set has to be re-authorized
+        if not creds.has_scopes(SCOPES):
+            creds = None
+        elif creds.expired and creds.refresh_token:
             creds.refresh(Request())
+            token_path.write_text(creds.to_json(), encoding="utf-8")
     if not creds or not creds.valid:
         flow = InstalledAppFlow.from_client_secrets_file(
-            str(ROOT_DIR / "client_secret.json"), GMAIL_SCOPES
+            str(ROOT_DIR / "client_secret.json"), SCOPES
         )
         creds = flow.run_local_server(port=0)
         token_path.write_text(creds.to_json(), encoding="utf-8")
-    return build("gmail", "v1", credentials=creds, cache_discovery=False)
+    return creds
+
+
+@lru_cache(maxsize=1)
+def get_authorized_http() -> google_auth_httplib2.AuthorizedHttp:
+    """One keep-alive ``httplib2.Http`` shared by every service of the run."""
+    return google_auth_httplib2.AuthorizedHttp(
+        get_credentials(), http=httplib2.Http(timeout=60)
+    )
+
+
+def get_gmail_service() -> object:
+    return build("gmail", "v1", http=get_authorized_http(), cache_discovery=False)
+
+
+def get_messages_batched(service, msg_ids: List[str], **params) -> Dict[str, Dict]:
+    """Fetch ``messages.get`` for every id using batch requests of up to 100 calls.
+
+    Messages whose call failed are left out; they stay unseen and are retried
+    on the next run.
+    """
+    messages: Dict[str, Dict] = {}
+
+    def on_response(request_id, response, exception):
+        if exception is None:
+            messages[request_id] = response
+
+    for start in range(0, len(msg_ids), GMAIL_BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=on_response)
+        for msg_id in msg_ids[start:start + GMAIL_BATCH_SIZE]:
+            batch.add(
+                service.users().messages().get(userId="me", id=msg_id, **params),
+                request_id=msg_id,
+            )
+        batch.execute()
+    return messages
+
+
+def parse_raw_message(raw: str) -> EmailMessage:
+    """Decode a ``format="raw"`` Gmail message into an ``EmailMessage``."""
+    return email.message_from_bytes(base64.urlsafe_b64decode(raw), policy=email.policy.default)
+
+
+def plain_text_body(msg: EmailMessage) -> str:
+    """Join the text of every ``text/plain`` part of ``msg``."""
+    return "\n".join(
+        part.get_content() for part in msg.walk() if part.get_content_type() == "text/plain"
+    )
 
 
 def search_new_messages(service, seen_ids: set[str]) -> List[tuple[str, int]]:
@@ -129,21 +255,15 @@ def search_new_messages(service, seen_ids: set[str]) -> List[tuple[str, int]]:
         '"Approved case"'
     )
     resp = service.users().messages().list(userId="me", q=query).execute()
+    new_ids = [m["id"] for m in resp.get("messages", []) if m["id"] not in seen_ids]
+    fetched = get_messages_batched(service, new_ids, format="raw", fields="raw")
     results = []
-    for msg in resp.get("messages", []):
-        msg_id = msg["id"]
-        if msg_id in seen_ids:
+    for msg_id in new_ids:
+        raw = fetched.get(msg_id)
+        if raw is None:
             continue
-        full = service.users().messages().get(
-            userId="me", id=msg_id, format="full"
-        ).execute()
-        headers = full.get("payload", {}).get("headers", [])
-        subject = next((h["value"] for h in headers if h["name"] == "Subject"), "")
-        body_data = full.get("payload", {}).get("body", {}).get("data")
-        body = ""
-        if body_data:
-            body = base64.urlsafe_b64decode(body_data).decode("utf-8", errors="ignore")
-        full_text = subject + "\n" + body
+        msg = parse_raw_message(raw["raw"])
+        full_text = msg.get("Subject", "") + "\n" + plain_text_body(msg)
         m = RE_APPROVED.search(full_text)
         if not m:
             continue
@@ -151,77 +271,114 @@ def search_new_messages(service, seen_ids: set[str]) -> List[tuple[str, int]]:
     return results
 
 
-def get_drive_service() -> tuple[object, Credentials]:
-    token_path = ROOT_DIR / "token.json"
-    creds = None
-    if token_path.exists():
-        creds = Credentials.from_authorized_user_file(str(token_path), DRIVE_SCOPES)
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-    if not creds or not creds.valid:
-        flow = InstalledAppFlow.from_client_secrets_file(
-            str(ROOT_DIR / "client_secret.json"), DRIVE_SCOPES
+def get_drive_services() -> tuple[object, object, Credentials]:
+    """Return ``(drive, sheets, creds)`` built on the run's shared credentials."""
+    http = get_authorized_http()
+    drive = build("drive", "v3", http=http, cache_discovery=False)
+    sheets = build("sheets", "v4", http=http, cache_discovery=False)
+    return drive, sheets, get_credentials()
+
+
+def get_drive_session(creds: Credentials) -> AuthorizedSession:
+    """Authorized HTTP session with a connection pool sized for the download pool."""
+    session = AuthorizedSession(creds)
+    session.mount("https://", HTTPAdapter(pool_maxsize=DOWNLOAD_WORKERS))
+    return session
+
+
+def _list_all(service, **params) -> List[Dict]:
+    """Run ``files.list`` across all drives and follow ``nextPageToken``."""
+    files: List[Dict] = []
+    page_token = None
+    while True:
+        resp = service.files().list(
+            supportsAllDrives=True,
+            includeItemsFromAllDrives=True,
+            corpora="allDrives",
+            pageSize=1000,
+            pageToken=page_token,
+            **params,
+        ).execute()
+        files.extend(resp.get("files", []))
+        page_token = resp.get("nextPageToken")
+        if not page_token:
+            return files
+
+
+def find_case_folders(service, names: List[str]) -> Dict[str, str]:
+    """Map each case folder name found under ROOT_FOLDER_ID to its id.
+
+    Names are OR-ed into one query per DRIVE_QUERY_CHUNK instead of one
+    request per case.
+    """
+    folders: Dict[str, str] = {}
+    for start in range(0, len(names), DRIVE_QUERY_CHUNK):
+        chunk = names[start:start + DRIVE_QUERY_CHUNK]
+        name_clause = " or ".join(f"name='{n}'" for n in chunk)
+        query = (
+            f"'{ROOT_FOLDER_ID}' in parents and "
+            "mimeType='application/vnd.google-apps.folder' and "
+            f"({name_clause}) and trashed=false"
         )
-        creds = flow.run_local_server(port=0)
-        token_path.write_text(creds.to_json(), encoding="utf-8")
-    service = build("drive", "v3", credentials=creds)
-    return service, creds
-
-
-def get_sheets_service(creds) -> object:
-    return build("sheets", "v4", credentials=creds)
+        for f in _list_all(service, q=query, fields="nextPageToken, files(id, name)"):
+            folders.setdefault(f["name"], f["id"])
+    return folders
+
+
+def list_pdfs_by_folder(service, folder_ids: List[str]) -> Dict[str, List[Dict]]:
+    """Map each folder id to its PDFs, newest first, with one query per chunk."""
+    pdfs: Dict[str, List[Dict]] = {fid: [] for fid in folder_ids}
+    for start in range(0, len(folder_ids), DRIVE_QUERY_CHUNK):
+        chunk = folder_ids[start:start + DRIVE_QUERY_CHUNK]
+        parent_clause = " or ".join(f"'{fid}' in parents" for fid in chunk)
+        query = f"({parent_clause}) and mimeType='application/pdf' and trashed=false"
+        files = _list_all(
+            service,
+            q=query,
+            orderBy="modifiedTime desc",
+            fields="nextPageToken, files(id, name, parents)",
+        )
+        for f in files:
+            for parent in f.get("parents", []):
+                if parent in pdfs:
+                    pdfs[parent].append(f)
+    return pdfs
 
 
-def find_case_folder(service, padded: str) -> Optional[str]:
-    query = (
-        f"'{ROOT_FOLDER_ID}' in parents and "
-        "mimeType='application/vnd.google-apps.folder' and "
-        f"name='{padded}' and trashed=false"
+def pick_latest(files: List[Dict], prefix: str) -> Optional[Dict]:
+    """Return the first (newest) file whose name starts with ``prefix``."""
+    return next(
+        (f for f in files if f["name"].lower().startswith(prefix.lower())), None
     )
-    resp = service.files().list(
-        q=query,
-        fields="files(id)",
-        supportsAllDrives=True,
-        includeItemsFromAllDrives=True,
-        corpora="allDrives",
-        pageSize=1,
-    ).execute()
-    files = resp.get("files", [])
-    return files[0]["id"] if files else None
-
-
-def find_latest_pdf(service, parent_id: str, prefix: str) -> Optional[Dict]:
-    resp = service.files().list(
-        q=f"'{parent_id}' in parents and mimeType='application/pdf' and trashed=false",
-        orderBy="modifiedTime desc",
-        fields="files(id, name)",
-        supportsAllDrives=True,
-        includeItemsFromAllDrives=True,
-        corpora="allDrives",
-        pageSize=100,
-    ).execute()
-    for f in resp.get("files", []):
-        if f["name"].lower().startswith(prefix.lower()):
-            return f
-    return None
 
 
 def clean_filename(name: str) -> str:
-    return re.sub(f"[{re.escape(FORBIDDEN)}]", "_", name).strip(" .")
+    return name.translate(_FORBIDDEN_TR).strip(" .")
 
 
-def download_pdf(service, file_meta: Dict, desired_name: str) -> Path:
+def download_pdf(session: AuthorizedSession, file_meta: Dict, desired_name: str) -> Path:
+    """Stream a Drive file to ``desired_name`` with one GET; safe to run in threads."""
     if not desired_name.lower().endswith(".pdf"):
         desired_name += ".pdf"
     desired_name = clean_filename(desired_name)
-    request = service.files().get_media(fileId=file_meta["id"])
-    fh = io.FileIO(desired_name, "wb")
-    downloader = MediaIoBaseDownload(fh, request)
-    done = False
-    while not done:
-        _, done = downloader.next_chunk()
-    fh.close()
-    return Path(desired_name)
+    path = ROOT_DIR / desired_name
+    with session.get(
+        f"{DRIVE_FILES_URL}/{file_meta['id']}",
+        params={"alt": "media", "supportsAllDrives": "true"},
+        stream=True,
+        timeout=60,
+    ) as resp:
+        resp.raise_for_status()
+        resp.raw.decode_content = True  # Drive may gzip the body
+        with io.FileIO(path, "wb") as fh:
+            shutil.copyfileobj(resp.raw, fh, DOWNLOAD_CHUNK)
+    return path
+
+
+def cached_download(flags: Dict, flag: str, name: str) -> Optional[Path]:
+    """Return the file a previous run already downloaded, if it is still there."""
+    path = ROOT_DIR / clean_filename(name)
+    return path if flags.get(flag) and path.exists() else None
 
 
 def load_parser():
@@ -244,13 +401,16 @@ def create_case_dir(date_iso: str, amount: float, invoice_number: int) -> Path:
     return path
 
 
-def append_row(sheets, row: List) -> None:
+def append_rows(sheets, rows: List[List]) -> None:
+    """Append all ``rows`` to the sheet with a single values.append call."""
+    if not rows:
+        return
     sheets.spreadsheets().values().append(
         spreadsheetId=SHEET_ID,
         range=SHEET_RANGE,
         valueInputOption="USER_ENTERED",
         insertDataOption="INSERT_ROWS",
-        body={"values": [row]},
+        body={"values": rows},
     ).execute()
 
 
@@ -272,85 +432,157 @@ def process():
     telegram_log: List[str] = []
     parser_module = load_parser()
 
-    cases_df = ensure_cases_excel()
-    seen_data = load_seen()
-    seen_msgs = set(seen_data.get("messages", []))
+    cases_df = load_cases()
+    existing_invoices: set[int] = set(cases_df["invoice_number"].dropna().astype(int))
+    seen = load_seen()
 
     # 1. Gmail
     try:
         gmail = get_gmail_service()
-        new_msgs = search_new_messages(gmail, seen_msgs)
+        new_msgs = search_new_messages(gmail, seen.messages)
     except Exception as e:
         new_msgs = []
         telegram_log.append(f"❌ Gmail error: {e}")
 
+    new_rows: List[Dict] = []
     for msg_id, inv_no in new_msgs:
-        if str(inv_no) not in cases_df["invoice_number"].astype(str).tolist():
-            new_row = {
-                "YY-MM": "",
-                "case_descr": "",
-                "amount": "",
-                "invoice_number": int(inv_no),
-                "Статус": "Ожидает Invoice",
-            }
-            cases_df = pd.concat([cases_df, pd.DataFrame([new_row])], ignore_index=True)
+        if int(inv_no) not in existing_invoices:
+            new_rows.append(
+                {
+                    "YY-MM": "",
+                    "case_descr": "",
+                    "amount": None,
+                    "invoice_number": int(inv_no),
+                    "Статус": "Ожидает Invoice",
+                }
+            )
+            existing_invoices.add(int(inv_no))
         telegram_log.append(f"📬 Найдено письмо: №{int(inv_no)}")
-        seen_msgs.add(msg_id)
-        seen_data.setdefault("cases", {}).setdefault(str(inv_no), asdict(CaseFlags()))
+        seen.add_message(msg_id)
+        seen.ensure_case(inv_no)
+    if new_rows:
+        cases_df = pd.concat(
+            [cases_df, pd.DataFrame(new_rows).astype(CASES_DTYPES)], ignore_index=True
+        )
 
     # Save initial data after Gmail stage
-    save_cases_excel(cases_df)
-    seen_data["messages"] = list(seen_msgs)
-    save_seen(seen_data)
-
-    # 2. Process cases
-    drive, creds = get_drive_service()
-    sheets = build("sheets", "v4", credentials=creds)
-
-    for idx, row in cases_df.iterrows():
-        status = str(row.get("Статус", ""))
-        if status == "Готово":
+    save_cases(cases_df)
+    save_seen(seen)
+
+    # 2. Process cases. State is written once at the end; the atexit hook
+    # also saves it if the run is interrupted (Ctrl+C, crash).
+    def save_state() -> None:
+        save_cases(cases_df)
+        save_seen(seen)
+
+    atexit.register(save_state)
+    drive, sheets, creds = get_drive_services()
+    session = get_drive_session(creds)
+
+    # 2a. Resolve case folders and their latest PDFs with a few batched queries
+    pending = [
+        (idx, int(inv))
+        for idx, inv, status in zip(
+            cases_df.index,
+            cases_df["invoice_number"].to_numpy(),
+            cases_df["Статус"].to_numpy(),
+        )
+        if str(status) != "Готово"
+    ]
+    # Sub-steps finished by an earlier run are not repeated: a cached parse
+    # result or files still lying in ROOT_DIR let a retry skip Drive entirely.
+    parsed_before: Dict[int, Dict] = {}
+    local_files: Dict[tuple[int, str], Path] = {}
+    to_lookup: List[tuple[int, int]] = []
+    for idx, invoice_number in pending:
+        flags = seen.cases.get(str(invoice_number), {})
+        for kind, flag in DOWNLOAD_FLAGS.items():
+            path = cached_download(flags, flag, f"{kind} {invoice_number}.pdf")
+            if path:
+                local_files[(idx, kind)] = path
+        if flags.get("parsed") and flags.get("parsed_info"):
+            parsed_before[idx] = flags["parsed_info"]
             continue
-        invoice_number = int(row["invoice_number"])
-        case_flags = seen_data.get("cases", {}).get(str(invoice_number), asdict(CaseFlags()))
-        padded = RE_CASE_FOLDER.format(invoice_number)
-        try:
-            folder_id = find_case_folder(drive, padded)
+        if (idx, "Invoice") not in local_files or (idx, "Grant Agreement") not in local_files:
+            to_lookup.append((idx, invoice_number))
+
+    looked_up = {idx for idx, _ in to_lookup}
+    cases: List[tuple] = [  # (idx, invoice_number, lookup error, {kind: file meta})
+        (idx, invoice_number, None, {})
+        for idx, invoice_number in pending
+        if idx not in looked_up
+    ]
+    try:
+        folder_by_name = find_case_folders(
+            drive, [RE_CASE_FOLDER.format(inv) for _, inv in to_lookup]
+        )
+        pdfs_by_folder = list_pdfs_by_folder(drive, list(folder_by_name.values()))
+    except Exception as e:
+        cases += [(idx, inv, e, {}) for idx, inv in to_lookup]
+    else:
+        for idx, invoice_number in to_lookup:
+            folder_id = folder_by_name.get(RE_CASE_FOLDER.format(invoice_number))
             if not folder_id:
-                raise RuntimeError("Папка-кейс не найдена")
-            invoice_meta = find_latest_pdf(drive, folder_id, "Invoice")
-            grant_meta = find_latest_pdf(drive, folder_id, "Grant Agreement")
-            inv_path = grant_path = None
-            if invoice_meta:
-                inv_path = download_pdf(
-                    drive, invoice_meta, f"Invoice {invoice_number}.pdf"
+                cases.append(
+                    (idx, invoice_number, RuntimeError("Папка-кейс не найдена"), {})
                 )
+                continue
+            metas = {
+                kind: pick_latest(pdfs_by_folder[folder_id], kind)
+                for kind in ("Invoice", "Grant Agreement")
+            }
+            cases.append((idx, invoice_number, None, metas))
+
+    # 2b. Download all PDFs concurrently; pandas is only touched in 2c
+    downloads: Dict[tuple[int, str], Future] = {}
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as pool:
+        for idx, invoice_number, _, metas in cases:
+            for kind, meta in metas.items():
+                if meta and (idx, kind) not in local_files:
+                    downloads[(idx, kind)] = pool.submit(
+                        download_pdf, session, meta, f"{kind} {invoice_number}.pdf"
+                    )
+
+    # 2c. Parse and build folders one case at a time; sheet rows are buffered
+    pending_sheet_rows: List[List] = []
+    pending_cases: List[tuple[int, int]] = []
+    for idx, invoice_number, lookup_error, _ in cases:
+        case_flags = seen.cases.get(str(invoice_number), asdict(CaseFlags()))
+        try:
+            if lookup_error:
+                raise lookup_error
+            inv_path = local_files.get((idx, "Invoice"))
+            grant_path = local_files.get((idx, "Grant Agreement"))
+            if (idx, "Invoice") in downloads:
+                inv_path = downloads[(idx, "Invoice")].result()
                 telegram_log.append(f"📥 скачан файл: {inv_path.name}")
                 case_flags["invoice_downloaded"] = True
-            if grant_meta:
-                grant_path = download_pdf(
-                    drive, grant_meta, f"Grant Agreement {invoice_number}.pdf"
-                )
+                seen.set_case(invoice_number, case_flags)
+            if (idx, "Grant Agreement") in downloads:
+                grant_path = downloads[(idx, "Grant Agreement")].result()
                 telegram_log.append(f"📥 скачан файл: {grant_path.name}")
                 case_flags["grant_downloaded"] = True
-
-            if inv_path:
-                info: Dict = parser_module.parse_invoice(str(inv_path))
+                seen.set_case(invoice_number, case_flags)
+
+            info: Optional[Dict] = parsed_before.get(idx)
+            if info or inv_path:
+                if info is None:
+                    info = parser_module.parse_invoice(str(inv_path))
+                    telegram_log.append("📊 Invoice распарсен")
+                    case_flags["parsed"] = True
+                    case_flags["parsed_info"] = info
+                    seen.set_case(invoice_number, case_flags)
                 yy_mm = datetime.fromisoformat(info["date"]).strftime("%y-%m")
-                cases_df.loc[idx, ["YY-MM", "case_descr", "amount"]] = [
-                    yy_mm,
-                    info.get("case_descr", ""),
-                    info.get("amount", ""),
-                ]
-                telegram_log.append("📊 Invoice распарсен")
-                case_flags["parsed"] = True
+                cases_df.at[idx, "YY-MM"] = yy_mm
+                cases_df.at[idx, "case_descr"] = info.get("case_descr", "")
+                cases_df.at[idx, "amount"] = float(info["amount"])
                 target_dir = create_case_dir(info["date"], info["amount"], invoice_number)
-                shutil.move(str(inv_path), target_dir / inv_path.name)
+                if inv_path:
+                    shutil.move(str(inv_path), target_dir / inv_path.name)
                 if grant_path:
                     shutil.move(str(grant_path), target_dir / grant_path.name)
                 telegram_log.append("📂 Папка сформирована")
-                append_row(
-                    sheets,
+                pending_sheet_rows.append(
                     [
                         info["date"],
                         "",
@@ -364,31 +596,54 @@ def process():
                         "",
                         "",
                         "хер",
-                    ],
+                    ]
                 )
-                telegram_log.append("📊 Добавлено в таблицу")
-                cases_df.loc[idx, "Статус"] = "Готово"
-                telegram_log.append(f"✅ Кейс №{invoice_number} обработан")
+                pending_cases.append((idx, invoice_number))
             else:
-                cases_df.loc[idx, "Статус"] = "Ошибка: Invoice не найден"
+                cases_df.at[idx, "Статус"] = "Ошибка: Invoice не найден"
                 telegram_log.append(
                     f"❌ Ошибка кейса №{invoice_number}: Invoice не найден"
                 )
                 case_flags["error"] = "Invoice not found"
         except Exception as e:
-            cases_df.loc[idx, "Статус"] = f"Ошибка: {e}"
+            cases_df.at[idx, "Статус"] = f"Ошибка: {e}"
             telegram_log.append(f"❌ Ошибка кейса №{invoice_number}: {e}")
             case_flags["error"] = str(e)
         finally:
-            seen_data.setdefault("cases", {})[str(invoice_number)] = case_flags
-            save_cases_excel(cases_df)
-            save_seen(seen_data)
+            seen.set_case(invoice_number, case_flags)
+
+    # 3. Sheets: every parsed case goes out in one append
+    if pending_sheet_rows:
+        try:
+            append_rows(sheets, pending_sheet_rows)
+        except Exception as e:
+            telegram_log.append(f"❌ Ошибка Sheets: {e}")
+            for idx, invoice_number in pending_cases:
+                cases_df.at[idx, "Статус"] = "Ошибка: Sheets"
+                seen.cases[str(invoice_number)]["error"] = f"Sheets: {e}"
+        else:
+            telegram_log.append(f"📊 Добавлено в таблицу: {len(pending_sheet_rows)}")
+            for idx, invoice_number in pending_cases:
+                cases_df.at[idx, "Статус"] = "Готово"
+                telegram_log.append(f"✅ Кейс №{invoice_number} обработан")
 
+    atexit.unregister(save_state)
+    save_state()
     send_telegram(telegram_log)
 
 
 if __name__ == "__main__":
-    try:
-        process()
-    except HttpError as e:
-        print(f"Google API error: {e}")
+    parser = argparse.ArgumentParser(description="Mega_Help Script v2")
+    parser.add_argument(
+        "--export-xlsx",
+        action="store_true",
+        help=f"Only write the case table to {CASES_XLSX.name} and exit",
+    )
+    args = parser.parse_args()
+    if args.export_xlsx:
+        export_cases_xlsx()
+    else:
+        try:
+            process()
+        except HttpError as e:
+            print(f"Google API error: {e}")
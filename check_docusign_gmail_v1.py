@@ -14,7 +14,7 @@ import pathlib
 import re
 import sys
 from datetime import datetime, timedelta
-from typing import List
+from typing import Dict, List, Set
 
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
@@ -28,6 +28,7 @@ SEEN_FILE        = 'seen_ids.json'             # обработанные пис
 # -----------------------------------------
 
 SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']  # или gmail.modify
+GMAIL_BATCH_SIZE = 100  # Gmail принимает не больше 100 вызовов в одном batch
 
 # ─── Gmail search query ─────────────────────────────────────────────────────────
 # «after:YYYY/MM/DD» берёт письма, полученные ПОСЛЕ указанной даты 00:00,
@@ -45,16 +46,17 @@ SUBJECT_RE = re.compile(r'for Approved case\s+(\d{8})', re.IGNORECASE)
 TZ         = ZoneInfo('Europe/Kyiv')           # для читаемых тайм-штампов
 
 
-def load_seen() -> List[str]:
+def load_seen() -> Set[str]:
+    """ID обработанных писем; в памяти держим set (проверка за O(1))."""
     if pathlib.Path(SEEN_FILE).exists():
         with open(SEEN_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return []
+            return set(json.load(f))
+    return set()
 
 
-def save_seen(seen: List[str]) -> None:
+def save_seen(seen: Set[str]) -> None:
     with open(SEEN_FILE, 'w', encoding='utf-8') as f:
-        json.dump(seen, f)
+        json.dump(list(seen), f)   # в JSON — список, set там не бывает
 
 
 def get_service():
@@ -82,6 +84,39 @@ def get_service():
     return build('gmail', 'v1', credentials=creds, cache_discovery=False)
 
 
+def get_subjects(service, msg_ids: List[str]) -> Dict[str, str]:
+    """
+    Темы писем msg_ids, batch-запросами по GMAIL_BATCH_SIZE вызовов.
+    Письма, чей get упал, в результат не попадают — их проверим в следующий запуск.
+    """
+    subjects: Dict[str, str] = {}
+
+    def on_response(request_id, response, exception):
+        if exception is not None:
+            print(f'⚠️  Не смог получить письмо {request_id}: {exception}', file=sys.stderr)
+            return
+        subjects[request_id] = next(
+            (h['value'] for h in response['payload']['headers'] if h['name'] == 'Subject'),
+            ''
+        )
+
+    for start in range(0, len(msg_ids), GMAIL_BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=on_response)
+        for msg_id in msg_ids[start:start + GMAIL_BATCH_SIZE]:
+            # только заголовок Subject (быстро)
+            batch.add(
+                service.users().messages().get(
+                    userId='me', id=msg_id,
+                    format='metadata',
+                    metadataHeaders=['Subject'],
+                    fields='payload/headers',
+                ),
+                request_id=msg_id,
+            )
+        batch.execute()
+    return subjects
+
+
 def extract_case_number(subject: str) -> str | None:
     """Возвращает 8-значный номер из темы или None."""
     m = SUBJECT_RE.search(subject)
@@ -89,26 +124,17 @@ def extract_case_number(subject: str) -> str | None:
 
 
 def main():
-    seen_ids = set(load_seen())
+    seen_ids = load_seen()
     service  = get_service()
 
     results  = service.users().messages().list(userId='me', q=GMAIL_QUERY).execute()
-    for msg in results.get('messages', []):
-        msg_id = msg['id']
-        if msg_id in seen_ids:         # уже обработан
-            continue
-
-        # Получаем только заголовки (быстро)
-        meta = service.users().messages().get(
-            userId='me', id=msg_id,
-            format='metadata',
-            metadataHeaders=['Subject']
-        ).execute()
+    new_ids  = [m['id'] for m in results.get('messages', []) if m['id'] not in seen_ids]
+    subjects = get_subjects(service, new_ids)   # один batch вместо get на каждое письмо
 
-        subject = next(
-            (h['value'] for h in meta['payload']['headers'] if h['name'] == 'Subject'),
-            ''
-        )
+    for msg_id in new_ids:
+        if msg_id not in subjects:     # get не удался — повторим в следующий раз
+            continue
+        subject = subjects[msg_id]
 
         number = extract_case_number(subject)
         if number:
@@ -120,7 +146,7 @@ def main():
 
         seen_ids.add(msg_id)
 
-    save_seen(list(seen_ids))
+    save_seen(seen_ids)
 
 
 if __name__ == '__main__':
@@ -5,10 +5,11 @@ import re
 import sys
 import shutil
 import pathlib
+import zipfile
 from datetime import datetime, timedelta
+from xml.sax.saxutils import escape
 
-import pdfplumber
-from docx import Document
+import pypdfium2 as pdfium
 
 CONSTANT_TEXT = "XXX"
 TEMPLATE_DOCX = "Письмо на Банк Благотворит.docx"
@@ -30,30 +31,36 @@ def ua_date(dt: datetime) -> str:
 
 def fill_docx(template: pathlib.Path, dest: pathlib.Path,
               plus2_dt: datetime, amount_full: str):
-    doc = Document(template)
+    # .docx — это zip: плейсхолдеры меняем прямо в байтах word/document.xml
+    # (там и абзацы, и таблицы), остальные части архива копируем как есть.
+    # Как и раньше, плейсхолдер в шаблоне должен целиком лежать в одном run.
     mapping = {
         "{{DATE}}":        ua_date(plus2_dt),
         "{{DATE + 1}}":    ua_date(plus2_dt),
         "{{FULL_AMOUNT}}": amount_full,
     }
-    for p in doc.paragraphs:
-        for k, v in mapping.items():
-            if k in p.text:
-                for r in p.runs:
-                    r.text = r.text.replace(k, v)
-    for tbl in doc.tables:
-        for row in tbl.rows:
-            for cell in row.cells:
-                for para in cell.paragraphs:
-                    for k, v in mapping.items():
-                        if k in para.text:
-                            for r in para.runs:
-                                r.text = r.text.replace(k, v)
-    doc.save(dest)
+    with zipfile.ZipFile(template) as src, zipfile.ZipFile(dest, "w") as dst:
+        for item in src.infolist():
+            data = src.read(item)
+            if item.filename == "word/document.xml":
+                for k, v in mapping.items():
+                    data = data.replace(k.encode(), escape(v).encode())
+            dst.writestr(item, data)
 
 def extract_from_pdf(pdf_path: pathlib.Path):
-    with pdfplumber.open(pdf_path) as pdf:
-        text = "\n".join(p.extract_text() or "" for p in pdf.pages)
+    # Текст читаем постранично: как только в прочитанном есть дата, строгий
+    # номер инвойса и «Total amount», следующие страницы уже ничего не изменят.
+    pages = []
+    pdf = pdfium.PdfDocument(pdf_path)
+    try:
+        for page in pdf:
+            pages.append(page.get_textpage().get_text_range())
+            text = "\n".join(pages)
+            if RE_DATE.search(text) and RE_INVNO.search(text) and RE_TOTALUSD.search(text):
+                break
+    finally:
+        pdf.close()
+    text = "\n".join(pages)
     m_date = RE_DATE.search(text)
     if not m_date:
         raise ValueError("Дата (M/D/YYYY) не найдена")
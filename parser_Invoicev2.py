@@ -30,16 +30,22 @@ from datetime import datetime as _dt
 from pathlib import Path
 from typing import Final
 
-import pdfplumber  # external dep
+import pypdfium2 as pdfium  # external dep (PDFium bindings)
 
 # ────────── regexes for old-layout invoice ──────────
-_RE_DATE: Final = re.compile(r"(\d{1,2})/(\d{1,2})/(\d{4})")
-_RE_INVNO: Final = re.compile(r"Invoice\s*No\.?\s*0*(\d{3,})", re.I)
-_RE_INVNO_FBK: Final = re.compile(r"\b000\d{5}\b")
-_RE_TOTALUSD: Final = re.compile(
-    r"Total\s+amount:?\s*USD\s+([\d\s,]+(?:\.\d{2})?)", re.I
+# date / invoice number (strict, fallback) / amount (total, any USD) in ONE
+# pass: each alternative sits inside a zero-width lookahead, so matches may
+# overlap exactly like the former independent searches; m.lastgroup tells
+# which field hit.
+_RE_FIELDS: Final = re.compile(
+    r"(?=(?:"
+    r"(?P<date>(?P<mm>\d{1,2})/(?P<dd>\d{1,2})/(?P<yyyy>\d{4}))"
+    r"|(?P<invno>(?i:Invoice\s*No\.?\s*0*(?P<invno_digits>\d{3,})))"
+    r"|(?P<invno_fbk>\b000\d{5}\b)"
+    r"|(?P<total>(?i:Total\s+amount:?\s*USD\s+(?P<total_amt>[\d\s,]+(?:\.\d{2})?)))"
+    r"|(?P<anyusd>(?i:USD\s+(?P<any_amt>[\d\s,]+(?:\.\d{2})?)))"
+    r"))"
 )
-_RE_ANYUSD: Final = re.compile(r"USD\s+([\d\s,]+(?:\.\d{2})?)", re.I)
 _RE_NON_DIGIT_DOT: Final = re.compile(r"[^\d\.]")
 
 # NEW: capture the first non-empty line between the header row
@@ -74,7 +80,8 @@ def parse_invoice(path: str | Path) -> dict:
     Algorithm
     ---------
     1. Check file exists.
-    2. Join text of all pages via pdfplumber.
+    2. Read page text via pypdfium2, one page at a time; stop as soon as
+       later pages can no longer change any field.
     3. Parse date (first MM/DD/YYYY).
     4. Parse invoice number (strict / fallback).
     5. Parse amount (prefer “Total amount: USD …”, else first “USD …”).
@@ -86,13 +93,48 @@ def parse_invoice(path: str | Path) -> dict:
     if not pdf_path.is_file():
         raise FileNotFoundError(pdf_path)
 
-    with pdfplumber.open(pdf_path) as pdf:
-        full_text: str = "\n".join(p.extract_text() or "" for p in pdf.pages)
+    pages_text: list[str] = []
+    fields: dict = {}
+    pdf = pdfium.PdfDocument(pdf_path)
+    try:
+        for page in pdf:
+            pages_text.append(page.get_textpage().get_text_range())
+            fields, settled = _extract_fields("\n".join(pages_text))
+            if settled:
+                break
+    finally:
+        pdf.close()
+
+    # 7️⃣ validation
+    missing = [
+        k
+        for k in ("invoice_number", "date", "amount", "case_descr")
+        if fields.get(k) in (None, "", [])
+    ]
+    if missing:
+        raise ValueError(f"parse_invoice: missing {', '.join(missing)}")
+
+    # 8️⃣ return
+    return fields
+
+
+def _extract_fields(full_text: str) -> tuple[dict, bool]:
+    """
+    Steps 3–6 on the text read so far. The flag is True when the preferred
+    hits (first date, strict invoice number, “Total amount”, description) are
+    all present, i.e. reading more pages cannot change the result.
+    """
+    # first hit of every field, one scan (stops once the preferred hits are in)
+    hits: dict[str, re.Match] = {}
+    for m in _RE_FIELDS.finditer(full_text):
+        hits.setdefault(m.lastgroup, m)  # type: ignore[arg-type]
+        if "date" in hits and "invno" in hits and "total" in hits:
+            break
 
     # 3️⃣ date
     date_iso = None
-    if (m_date := _RE_DATE.search(full_text)):
-        mm, dd, yyyy = map(int, m_date.groups())
+    if (m_date := hits.get("date")):
+        mm, dd, yyyy = map(int, m_date.group("mm", "dd", "yyyy"))
         try:
             date_iso = _dt(yyyy, mm, dd).date().isoformat()
         except ValueError:
@@ -100,16 +142,19 @@ def parse_invoice(path: str | Path) -> dict:
 
     # 4️⃣ invoice number
     invoice_number = None
-    if (m_inv := _RE_INVNO.search(full_text)):
-        invoice_number = m_inv.group(1)
-    elif (m_fb := _RE_INVNO_FBK.search(full_text)):
-        invoice_number = m_fb.group(0).lstrip("0")
+    if (m_inv := hits.get("invno")):
+        invoice_number = m_inv.group("invno_digits")
+    elif (m_fb := hits.get("invno_fbk")):
+        invoice_number = m_fb.group("invno_fbk").lstrip("0")
 
     # 5️⃣ amount
     amount = None
-    m_amt = _RE_TOTALUSD.search(full_text) or _RE_ANYUSD.search(full_text)
+    if (m_amt := hits.get("total")):
+        raw_amt = m_amt.group("total_amt")
+    elif (m_amt := hits.get("anyusd")):
+        raw_amt = m_amt.group("any_amt")
     if m_amt:
-        raw = _RE_NON_DIGIT_DOT.sub("", m_amt.group(1))
+        raw = _RE_NON_DIGIT_DOT.sub("", raw_amt)
         try:
             amount = float(raw)
         except ValueError:
@@ -118,24 +163,13 @@ def parse_invoice(path: str | Path) -> dict:
     # 6️⃣ description
     case_descr = _find_case_descr(full_text)
 
-    # 7️⃣ validation
-    missing = [
-        k
-        for k, v in {
-            "invoice_number": invoice_number,
-            "date": date_iso,
-            "amount": amount,
-            "case_descr": case_descr,
-        }.items()
-        if v in (None, "", [])
-    ]
-    if missing:
-        raise ValueError(f"parse_invoice: missing {', '.join(missing)}")
-
-    # 8️⃣ return
+    settled = (
+        "date" in hits and "invno" in hits and "total" in hits
+        and case_descr is not None
+    )
     return {
-        "invoice_number": invoice_number,  # type: ignore[arg-type]
-        "date": date_iso,                  # type: ignore[arg-type]
-        "amount": amount,                  # type: ignore[arg-type]
-        "case_descr": case_descr,          # type: ignore[arg-type]
-    }
+        "invoice_number": invoice_number,
+        "date": date_iso,
+        "amount": amount,
+        "case_descr": case_descr,
+    }, settled